@@ -6,22 +6,40 @@ from .utils import (
     make_dbconnection,
     get_tileids_and_tforms,
     get_matches,
+    get_matches_for_pairs,
     write_chunk_to_file,
+    read_chunk_files,
+    read_chunk_signatures,
     write_reg_and_tforms,
     write_to_new_stack,
     EMalignerException,
     logger2)
-from .transform.transform import AlignerTransform
+from .cache import (
+    MatchCache,
+    TileSpecCache,
+    match_signature,
+    render_pair_counts)
+from .solvers import (
+    make_solver,
+    uv_halves,
+    tile_columns,
+    factorization_cache)
+from .transform.transform import AlignerTransform, AlignerAffineModel
 import time
 import scipy.sparse as sparse
-from scipy.sparse import csr_matrix
-from scipy.sparse.linalg import factorized
+from scipy.sparse import csr_matrix, coo_matrix
 import warnings
 import os
 import sys
 import multiprocessing
 import logging
 import json
+import hashlib
+import shutil
+import tempfile
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
 warnings.simplefilter(action='ignore', category=FutureWarning)
 import h5py
 warnings.resetwarnings()
@@ -29,13 +47,404 @@ warnings.resetwarnings()
 logger = logging.getLogger(__name__)
 
 
+# database connections, reused by all the tasks a process runs
+worker_connections = {}
+
+# args and tile index, sent once to each worker by the pool initializer
+worker_state = {}
+
+
+class TileIndex(object):
+    """tile ids presorted once, for id to column lookups"""
+
+    def __init__(self, tile_ids):
+        self.sorter = np.argsort(tile_ids)
+        self.sorted_ids = np.asarray(tile_ids)[self.sorter]
+
+    def lookup(self, ids):
+        # column in tile_ids for each id, and whether it was found
+        pos = np.searchsorted(self.sorted_ids, ids)
+        pos[pos == self.sorted_ids.size] = 0
+        found = self.sorted_ids[pos] == ids
+        return self.sorter[pos], found
+
+
+def initialize_worker(args, tile_index, scratch_dir=''):
+    # pool initializer, opens the long-lived connection for this worker
+    # connections inherited from a forked parent are not safe to share
+    worker_connections.clear()
+    worker_state['args'] = args
+    worker_state['tile_index'] = tile_index
+    worker_state['scratch_dir'] = scratch_dir
+    worker_dbconnection(args['pointmatch'])
+
+
+def worker_dbconnection(collection):
+    # one database connection per collection, per process
+    key = json.dumps(collection, sort_keys=True)
+    if key not in worker_connections:
+        worker_connections[key] = make_dbconnection(collection)
+    return worker_connections[key]
+
+
 def calculate_processing_chunk(fargs):
     # set up for calling using multiprocessing pool
-    [pair, zloc, args, tile_ids] = fargs
+    [pair, zloc] = fargs
+    return finish_chunk(assemble_pair(pair, zloc))
+
+
+def calculate_processing_block(fargs):
+    # several section pairs, with one point match query per collection
+    [pairs, zlocs] = fargs
+    return [finish_chunk(c) for c in assemble_block(pairs, zlocs)]
+
+
+def calculate_file_signature(fargs):
+    # signature of one hdf5 file, from its section pairs and tile_key,
+    # which identifies the columns of the file's tiles
+    [pairs, tile_key] = fargs
+    return chunk_signature(pairs, tile_key, worker_state['args'])
+
+
+def write_file_chunks(chunks, hdf5_options, signature, tiles_used):
+    # one hdf5 file from the chunks of its section pairs, from a writer
+    # thread. Their scratch files can go once it is written
+    try:
+        return write_chunks(
+            chunks, hdf5_options,
+            signature=signature, tiles_used=tiles_used)
+    finally:
+        for chunk in chunks:
+            remove_shared_chunk(chunk)
+
+
+# matrix_assembly settings that change the assembled rows
+signature_settings = [
+    'depth', 'explicit_weight_by_depth', 'cross_pt_weight',
+    'montage_pt_weight', 'npts_min', 'npts_max', 'choose_random',
+    'inverse_dz']
+
+
+def chunk_signature(pairs, tile_key, args):
+    # hash of what determines a matrix file: point match signatures
+    # of the section pairs, tile columns and assembly settings
+    dbconnection = worker_dbconnection(args['pointmatch'])
+    match_signatures = []
+    for pair in pairs:
+        match_signatures.append(match_signature(
+            pair['section1'],
+            pair['section2'],
+            args['pointmatch'],
+            dbconnection))
+    key = [
+        tile_key,
+        [[int(p['z1']), int(p['z2']), p['section1'], p['section2']]
+         for p in pairs],
+        match_signatures,
+        [args['pointmatch'][k] for k in ['owner', 'project', 'name']],
+        [args[k] for k in [
+            'transformation', 'fullsize_transform', 'poly_order']],
+        {k: args['matrix_assembly'][k] for k in signature_settings}]
+    return hashlib.sha1(
+        json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def tile_columns_key(tile_ids, tile_zvals, zvals):
+    # hash of the ids and columns of the tiles in sections zvals
+    ind = np.flatnonzero(np.isin(tile_zvals, zvals))
+    h = hashlib.sha1('\n'.join(tile_ids[ind]).encode('utf-8'))
+    h.update(ind.astype('int64').tobytes())
+    return h.hexdigest()
+
+
+def assemble_pair(pair, zloc):
+    args = worker_state['args']
+
+    # get point matches
+    t0 = time.time()
+    matches = get_matches(
+        pair['section1'],
+        pair['section2'],
+        args['pointmatch'],
+        worker_dbconnection(args['pointmatch']),
+        as_arrays=True,
+        cache=MatchCache.from_args(args['cache']))
+
+    return assemble_section_pair(
+        pair, zloc, args, worker_state['tile_index'], matches, t0)
+
+
+def assemble_block(pairs, zlocs):
+    args = worker_state['args']
+
+    t0 = time.time()
+    block_matches = get_matches_for_pairs(
+        [(pair['section1'], pair['section2']) for pair in pairs],
+        args['pointmatch'],
+        worker_dbconnection(args['pointmatch']),
+        cache=MatchCache.from_args(args['cache']))
+
+    chunks = []
+    for pair, zloc, matches in zip(pairs, zlocs, block_matches):
+        chunks.append(assemble_section_pair(
+            pair, zloc, args, worker_state['tile_index'], matches, t0))
+    return chunks
+
+
+def use_normal_equations(args):
+    return args['matrix_assembly']['normal_equations'] & \
+        (args['output_mode'] != 'hdf5')
+
+
+def finish_chunk(chunk):
+    # worker side products of a chunk, before it goes back to the parent
+    if use_normal_equations(worker_state['args']):
+        chunk['K'] = partial_normal_equations(chunk)
+    return share_chunk(chunk, worker_state['scratch_dir'])
+
+
+def partial_normal_equations(chunk):
+    # this chunk's part of K = A^T W A, as (row, col, data)
+    # computed on the columns the chunk uses, then mapped back
+    if chunk['data'] is None:
+        return None
+    cols, local = np.unique(chunk['indices'], return_inverse=True)
+    A = csr_matrix(
+        (chunk['data'], local.ravel(), chunk['indptr']),
+        shape=(chunk['nrows'], cols.size))
+    rtWA = sparse.diags(np.sqrt(chunk['weights'])).dot(A)
+    K = rtWA.transpose().dot(rtWA).tocoo()
+    return cols[K.row], cols[K.col], K.data
+
+
+class SparseSum(object):
+    """square sparse matrices, given as (row, col, data), summed into
+    CSR whenever the pending entries outnumber the summed nonzeros"""
+
+    def __init__(self, n):
+        self.n = n
+        self.total = csr_matrix((n, n))
+        self.pending = []
+        self.npending = 0
+
+    def add(self, row, col, data):
+        self.pending.append((row, col, data))
+        self.npending += data.size
+        if self.npending > max(self.total.nnz, 2**20):
+            self.compress()
+
+    def compress(self):
+        if self.npending == 0:
+            return
+        part = coo_matrix(
+            (np.concatenate([p[2] for p in self.pending]),
+             (np.concatenate([p[0] for p in self.pending]),
+              np.concatenate([p[1] for p in self.pending]))),
+            shape=(self.n, self.n))
+        self.total = self.total + part.tocsr()
+        self.pending = []
+        self.npending = 0
+
+    def result(self, n):
+        self.compress()
+        self.total.resize((n, n))
+        return self.total
+
+
+def share_chunk(chunk, scratch_dir):
+    # write the chunk arrays to scratch files and return only their names
+    # the parent memory maps them instead of unpickling copies
+    if (scratch_dir == '') | (chunk['data'] is None):
+        return chunk
+    for key in ['data', 'indices', 'indptr', 'weights']:
+        fd, fname = tempfile.mkstemp(dir=scratch_dir, suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, chunk[key])
+        chunk[key] = fname
+    return chunk
 
-    dbconnection = make_dbconnection(args['pointmatch'])
-    sorter = np.argsort(tile_ids)
 
+def chunk_array(chunk, key):
+    # array from a chunk, memory mapped if it was shared by file
+    if isinstance(chunk[key], str):
+        return np.load(chunk[key], mmap_mode='r')
+    return chunk[key]
+
+
+def remove_shared_chunk(chunk):
+    # scratch files can go once a chunk has been copied
+    if (chunk['data'] is None) | (not isinstance(chunk['data'], str)):
+        return
+    for key in ['data', 'indices', 'indptr', 'weights']:
+        os.remove(chunk[key])
+
+
+def concatenate_chunks(chunks):
+    # copied once, into arrays of the final size
+    chunks = [c for c in chunks if c['data'] is not None]
+    cbuf = ChunkBuffer(
+        np.sum([c['nnz'] for c in chunks]).astype('int64'),
+        np.sum([c['nrows'] for c in chunks]).astype('int64'))
+    for c in chunks:
+        cbuf.append(c)
+    return cbuf.result()
+
+
+def write_chunks(chunks, hdf5_options, signature=None, tiles_used=None):
+    cat_chunk = concatenate_chunks(chunks)
+    if cat_chunk['data'] is None:
+        return None
+    c = csr_matrix((
+        cat_chunk['data'],
+        cat_chunk['indices'],
+        cat_chunk['indptr']))
+    fname = hdf5_options['output_dir'] + \
+        '/%d_%d.h5' % (
+        cat_chunk['zlist'].min(),
+        cat_chunk['zlist'].max())
+    return write_chunk_to_file(
+        fname, c, cat_chunk['weights'], hdf5_options,
+        signature=signature, tiles_used=tiles_used)
+
+
+class ChunkBuffer(object):
+    """CSR chunks appended into arrays that grow as needed"""
+
+    def __init__(self, nnz=0, nrows=0):
+        self.data = np.zeros(nnz, dtype='float64')
+        self.indices = np.zeros(nnz, dtype='int64')
+        self.weights = np.zeros(nrows, dtype='float64')
+        self.indptr = np.zeros(nrows + 1, dtype='int64')
+        self.zlist = []
+        self.nnz = 0
+        self.nrows = 0
+
+    def grow(self, name, size):
+        # at least double, so appends are amortized O(1)
+        a = getattr(self, name)
+        if size > a.size:
+            b = np.zeros(max(size, 2 * a.size), dtype=a.dtype)
+            b[0:a.size] = a
+            setattr(self, name, b)
+
+    def append(self, chunk):
+        if chunk['data'] is None:
+            return
+        n = chunk['nnz']
+        m = chunk['nrows']
+        i = self.nnz
+        j = self.nrows
+        self.grow('data', i + n)
+        self.grow('indices', i + n)
+        self.grow('weights', j + m)
+        self.grow('indptr', j + m + 1)
+        self.data[i:(i + n)] = chunk_array(chunk, 'data')
+        self.indices[i:(i + n)] = chunk_array(chunk, 'indices')
+        self.weights[j:(j + m)] = chunk_array(chunk, 'weights')
+        self.indptr[(j + 1):(j + m + 1)] = \
+            chunk_array(chunk, 'indptr')[1:] + i
+        self.zlist.append(chunk['zlist'])
+        self.nnz += n
+        self.nrows += m
+
+    def result(self):
+        cat = {
+            'data': None,
+            'weights': None,
+            'indices': None,
+            'indptr': None,
+            'zlist': None}
+        if self.nrows == 0:
+            return cat
+        cat['data'] = self.data[0:self.nnz]
+        cat['indices'] = self.indices[0:self.nnz]
+        cat['weights'] = self.weights[0:self.nrows]
+        cat['indptr'] = self.indptr[0:(self.nrows + 1)]
+        cat['zlist'] = np.concatenate(self.zlist)
+        return cat
+
+
+def run_indexed(fargs):
+    # keeps the task position with results that come back unordered
+    [i, func, args] = fargs
+    return i, func(args)
+
+
+def imap_bounded(pool, func, fargs, max_in_flight):
+    # results of func over fargs, in order. At most max_in_flight tasks
+    # are submitted and not yet consumed, so memory stays bounded
+    slots = threading.Semaphore(max_in_flight)
+    stop = threading.Event()
+
+    def tasks():
+        for i, args in enumerate(fargs):
+            slots.acquire()
+            if stop.is_set():
+                return
+            yield [i, func, args]
+
+    def ordered(unordered):
+        done = {}
+        inext = 0
+        try:
+            for i, result in unordered:
+                done[i] = result
+                while inext in done:
+                    yield done.pop(inext)
+                    inext += 1
+                    slots.release()
+        finally:
+            # a task failed, or results are no longer consumed. The pool's
+            # task handler thread, waiting for a slot, would never exit
+            stop.set()
+            slots.release()
+
+    # submitted now, so the pool can be closed before consuming
+    return ordered(pool.imap_unordered(run_indexed, tasks()))
+
+
+class SerialPool(object):
+    """the parts of multiprocessing.Pool used for assembly, running
+    the tasks in this process. For pool workers, which cannot start
+    pools of their own"""
+
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def map(self, func, iterable):
+        return [func(i) for i in iterable]
+
+    def imap_unordered(self, func, iterable):
+        return (func(i) for i in iterable)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def initialize_section_worker(args):
+    # pool initializer for montage sections solved in parallel
+    worker_state['montage'] = EMaligner(input_data=args, args=[])
+    worker_state['montage'].tilespec_cache = \
+        TileSpecCache.from_args(args['cache'])
+
+
+def solve_montage_section(z):
+    # load, assemble, solve and ingest one section
+    mod = worker_state['montage']
+    ingestconn = None
+    if mod.args['output_mode'] == 'stack':
+        ingestconn = make_dbconnection(mod.args['output_stack'])
+    return z, mod.assemble_and_solve(np.array([z]), ingestconn)
+
+
+def assemble_section_pair(pair, zloc, args, tile_index, matches, t0):
     # this dict will get returned
     chunk = {}
     chunk['tiles_used'] = []
@@ -44,33 +453,28 @@ def calculate_processing_chunk(fargs):
     chunk['indptr'] = None
     chunk['weights'] = None
     chunk['nchunks'] = 0
+    chunk['nnz'] = 0
+    chunk['nrows'] = 0
     chunk['zlist'] = []
 
     pstr = '  proc%d: ' % zloc
 
-    # get point matches
-    t0 = time.time()
-    matches = get_matches(
-        pair['section1'],
-        pair['section2'],
-        args['pointmatch'],
-        dbconnection)
-
     if len(matches) == 0:
         return chunk
 
-    pid_set = set(m['pId'] for m in matches)
-    qid_set = set(m['qId'] for m in matches)
-
-    tile_set = set(tile_ids)
-
-    pid_set.intersection_update(tile_set)
-    qid_set.intersection_update(tile_set)
-
-    matches = [m for m in matches if m['pId']
-               in pid_set and m['qId'] in qid_set]
-    pids = np.array([m['pId'] for m in matches])
-    qids = np.array([m['qId'] for m in matches])
+    # for the given point matches, these are the indices in tile_ids
+    # these determine the column locations in A for each tile pair
+    pinds, pfound = tile_index.lookup(matches.pId)
+    qinds, qfound = tile_index.lookup(matches.qId)
+    in_stack = pfound & qfound
+    nloaded = np.union1d(
+        matches.pId[in_stack], matches.qId[in_stack]).size
+
+    matches = matches.select(in_stack)
+    pids = matches.pId
+    qids = matches.qId
+    pinds = pinds[in_stack]
+    qinds = qinds[in_stack]
 
     if len(matches) == 0:
         logger.debug(
@@ -84,7 +488,7 @@ def calculate_processing_chunk(fargs):
         "for groupIds %s and %s in %0.1f sec "
         "using interface: %s" % (
             pstr,
-            len(pid_set.union(qid_set)),
+            nloaded,
             len(matches),
             pair['section1'],
             pair['section2'],
@@ -92,92 +496,45 @@ def calculate_processing_chunk(fargs):
             args['pointmatch']['db_interface']))
 
     t0 = time.time()
-    # for the given point matches, these are the indices in tile_ids
-    # these determine the column locations in A for each tile pair
-    # this is a fast version of np.argwhere() loop
-    pinds = sorter[np.searchsorted(tile_ids, pids, sorter=sorter)]
-    qinds = sorter[np.searchsorted(tile_ids, qids, sorter=sorter)]
-
-    # conservative pre-allocation of the arrays we need to populate
-    # will truncate at the end
-    nmatches = len(matches)
     transform = AlignerTransform(
         args['transformation'],
         fullsize=args['fullsize_transform'],
         order=args['poly_order'])
-    nd = (
-        transform.nnz_per_row *
-        transform.rows_per_ptmatch *
-        args['matrix_assembly']['npts_max'] *
-        nmatches)
-    ni = (
-        transform.rows_per_ptmatch *
-        args['matrix_assembly']['npts_max'] *
-        nmatches)
-    data = np.zeros(nd).astype('float64')
-    indices = np.zeros(nd).astype('int64')
-    indptr = np.zeros(ni + 1).astype('int64')
-    weights = np.zeros(ni).astype('float64')
 
-    # see definition of CSR format, wikipedia for example
-    indptr[0] = 0
+    # all tile pairs of this section pair, assembled at once
+    data, indices, indptr, weights, npts = transform.CSR_from_tilepairs(
+        matches,
+        pinds,
+        qinds,
+        args['matrix_assembly']['npts_min'],
+        args['matrix_assembly']['npts_max'],
+        args['matrix_assembly']['choose_random'])
+    del matches
+
+    if data is None:
+        # if npts<nmin, or all weights=0, for every tile pair
+        return chunk
 
-    # track how many rows
-    nrows = 0
+    # add both tile ids to the list
+    used = npts != 0
+    chunk['tiles_used'] = np.vstack(
+        (pids[used], qids[used])).transpose().flatten().tolist()
 
-    tilepair_weightfac = tilepair_weight(
+    weights *= tilepair_weight(
         pair['z1'],
         pair['z2'],
         args['matrix_assembly'])
 
-    for k in np.arange(nmatches):
-        # create the CSR sub-matrix for this tile pair
-        d, ind, iptr, wts, npts = transform.CSR_from_tilepair(
-            matches[k],
-            pinds[k],
-            qinds[k],
-            args['matrix_assembly']['npts_min'],
-            args['matrix_assembly']['npts_max'],
-            args['matrix_assembly']['choose_random'])
-
-        if d is None:
-            continue  # if npts<nmin, or all weights=0
-
-        # add both tile ids to the list
-        chunk['tiles_used'].append(matches[k]['pId'])
-        chunk['tiles_used'].append(matches[k]['qId'])
-
-        # add sub-matrix to global matrix
-        global_dind = np.arange(
-            npts *
-            transform.rows_per_ptmatch *
-            transform.nnz_per_row) + \
-            nrows*transform.nnz_per_row
-        data[global_dind] = d
-        indices[global_dind] = ind
-
-        global_rowind = \
-            np.arange(npts * transform.rows_per_ptmatch) + nrows
-        weights[global_rowind] = wts * tilepair_weightfac
-        indptr[global_rowind + 1] = iptr + indptr[nrows]
-
-        nrows += wts.size
-
-    del matches
-    # truncate, because we allocated conservatively
-    data = data[0: nrows * transform.nnz_per_row]
-    indices = indices[0: nrows * transform.nnz_per_row]
-    indptr = indptr[0: nrows + 1]
-    weights = weights[0: nrows]
-
-    chunk['data'] = np.copy(data)
-    chunk['weights'] = np.copy(weights)
-    chunk['indices'] = np.copy(indices)
-    chunk['indptr'] = np.copy(indptr)
+    # see definition of CSR format, wikipedia for example
+    chunk['data'] = data
+    chunk['weights'] = weights
+    chunk['indices'] = indices
+    chunk['indptr'] = np.insert(indptr, 0, 0).astype('int64')
+    chunk['nnz'] = data.size
+    chunk['nrows'] = weights.size
     chunk['zlist'].append(pair['z1'])
     chunk['zlist'].append(pair['z2'])
     chunk['zlist'] = np.array(chunk['zlist'])
-    del data, indices, indptr, weights
 
     return chunk
 
@@ -196,6 +553,64 @@ def tilepair_weight(z1, z2, matrix_assembly):
     return tp_weight
 
 
+def log_section_results(section_results, title='montage of %d sections'):
+    # one line per montage section, or per 3D window by its first z
+    message = ' ' + title % len(section_results) + '\n'
+    message += '%10s %10s %10s %8s\n' % ('z', 'precision', 'error', 'sec')
+    for z in sorted(section_results.keys()):
+        r = section_results[z]
+        if r is None:
+            # file output, no solve
+            continue
+        message += '%10d %10.1e %10.3f %8.2f\n' % (
+            z, r['precision'], r['error'], r['time'])
+    logger.info(message)
+
+
+def tile_centers(tspecs, shared_tforms):
+    # x, y of each tile center with its transforms applied, and z
+    xyz = np.zeros((len(tspecs), 3))
+    for i, t in enumerate(tspecs):
+        xyz[i, 0:2] = renderapi.transform.estimate_dstpts(
+            t.tforms,
+            src=np.array([[t.width / 2.0, t.height / 2.0]]),
+            reference_tforms=shared_tforms)[0]
+        xyz[i, 2] = t.z
+    return xyz
+
+
+def compact_columns(m, keep, rows=False):
+    # drop the columns of a CSR matrix that are not in keep, and the
+    # rows too for a square matrix, by renumbering the column indices
+    # in place. The dropped columns (and rows) must be empty
+    newcol = (np.cumsum(keep) - 1).astype(m.indices.dtype)
+    np.take(newcol, m.indices, out=m.indices, mode='clip')
+    ncols = int(np.count_nonzero(keep))
+    indptr = m.indptr
+    nrows = m.shape[0]
+    if rows:
+        indptr = indptr[np.concatenate(([0], np.flatnonzero(keep) + 1))]
+        nrows = ncols
+    return csr_matrix((m.data, m.indices, indptr), shape=(nrows, ncols))
+
+
+def select_columns(data, indices, indptr, weights, keep):
+    # CSR arrays with only the rows that use no columns outside keep,
+    # and the kept columns renumbered
+    nrows = indptr.size - 1
+    row = np.repeat(np.arange(nrows), np.diff(indptr))
+    keep_row = np.ones(nrows, dtype=bool)
+    keep_row[row[~keep[indices]]] = False
+    keep_entry = keep_row[row]
+    newcol = np.cumsum(keep) - 1
+    counts = np.diff(indptr)[keep_row]
+    return (
+        data[keep_entry],
+        newcol[indices[keep_entry]],
+        np.concatenate(([0], np.cumsum(counts))).astype('int64'),
+        weights[keep_row])
+
+
 def mat_stats(m, name):
     shape = m.get_shape()
     mesg = "\n matrix: %s\n" % name
@@ -207,11 +622,21 @@ def mat_stats(m, name):
 
 class EMaligner(argschema.ArgSchemaParser):
     default_schema = EMA_Schema
+    tilespec_cache = None
+    tile_positions = None
+    # for windowed 3D solves, the sections shared with the next window
+    # and the solution of the previous window's shared sections
+    overlap_zvals = None
+    overlap_solution = None
 
     def run(self):
         logger.setLevel(self.args['log_level'])
         logger2.setLevel(self.args['log_level'])
         t0 = time.time()
+        # shared by all the z values of a montage run
+        self.tilespec_cache = TileSpecCache.from_args(self.args['cache'])
+        # point match collections may have changed since the last run
+        render_pair_counts.clear()
         zvals = np.arange(
             self.args['first_section'],
             self.args['last_section'] + 1)
@@ -239,13 +664,34 @@ class EMaligner(argschema.ArgSchemaParser):
                 if z in z_in_stack:
                     newzvals.append(z)
             zvals = np.array(newzvals)
-            for z in zvals:
-                self.results = self.assemble_and_solve(
-                    np.array([z]),
-                    ingestconn)
+            self.section_results = {}
+            if (self.args['n_parallel_sections'] > 1) & (zvals.size > 1):
+                pool = multiprocessing.Pool(
+                    min(self.args['n_parallel_sections'], zvals.size),
+                    initializer=initialize_section_worker,
+                    initargs=(self.args,),
+                    maxtasksperchild=self.args['maxtasksperchild'])
+                # in z order, as the sections finish
+                for z, results in pool.imap(
+                        solve_montage_section, zvals.tolist()):
+                    self.section_results[z] = results
+                    self.results = results
+                pool.close()
+                pool.join()
+            else:
+                for z in zvals:
+                    self.results = self.assemble_and_solve(
+                        np.array([z]),
+                        ingestconn)
+                    self.section_results[int(z)] = self.results
+            log_section_results(self.section_results)
         # 3D
         elif self.args['solve_type'] == '3D':
-            self.results = self.assemble_and_solve(zvals, ingestconn)
+            if (self.args['window_size'] > 0) & \
+                    (zvals.size > self.args['window_size']):
+                self.solve_windows(zvals, ingestconn)
+            else:
+                self.results = self.assemble_and_solve(zvals, ingestconn)
 
         if ingestconn is not None:
             if self.args['close_stack']:
@@ -255,6 +701,57 @@ class EMaligner(argschema.ArgSchemaParser):
                     render=ingestconn)
         logger.info(' total time: %0.1f' % (time.time() - t0))
 
+    def solve_windows(self, zvals, ingestconn):
+        # 3D solves of window_size sections at a time. Each window
+        # starts with the last window_overlap sections of the one before,
+        # constrained to that solution, and writes over their output
+        size = self.args['window_size']
+        overlap = self.args['window_overlap']
+        self.window_results = {}
+        self.overlap_solution = None
+        for start in range(0, max(1, zvals.size - overlap), size - overlap):
+            window = zvals[start:start + size]
+            logger.info(' solving sections %d to %d' % (
+                window[0], window[-1]))
+            self.overlap_zvals = window[window.size - overlap:]
+            self.results = self.assemble_and_solve(window, ingestconn)
+            self.window_results[int(window[0])] = self.results
+        self.overlap_zvals = None
+        self.overlap_solution = None
+        log_section_results(
+            self.window_results, title='3D solve of %d windows')
+
+    def constrain_overlap(self, assemble_result):
+        # start from, and regularize more strongly towards,
+        # the previous window's solution for the tiles shared with it
+        prev = self.overlap_solution
+        if prev['tids'].size == 0:
+            return
+        ncols_per_tile = \
+            self.transform.DOF_per_tile // assemble_result['tforms'].shape[1]
+        cols, found = TileIndex(prev['tids']).lookup(assemble_result['tids'])
+        rows = tile_columns(np.flatnonzero(found), ncols_per_tile)
+        assemble_result['tforms'][rows] = \
+            prev['x'][tile_columns(cols[found], ncols_per_tile)]
+        factor = np.ones(assemble_result['tforms'].shape[0])
+        factor[rows] = self.args['window_overlap_factor']
+        assemble_result['reg'] = \
+            sparse.diags(factor).dot(assemble_result['reg']).tocsr()
+        logger.info(' %d tiles constrained to the previous window' % (
+            found.sum()))
+
+    def keep_overlap_solution(self, assemble_result, x):
+        # the solution for the sections the next window starts with
+        # x is 1-D for single column transforms, stored as tforms are
+        ncols = assemble_result['tforms'].shape[1]
+        x = np.reshape(x, (-1, ncols))
+        tile_z = np.array([t.z for t in assemble_result['tspecs']])
+        ind = np.flatnonzero(np.isin(tile_z, self.overlap_zvals))
+        ncols_per_tile = self.transform.DOF_per_tile // ncols
+        self.overlap_solution = {
+            'tids': assemble_result['tids'][ind],
+            'x': x[tile_columns(ind, ncols_per_tile)]}
+
     def assemble_and_solve(self, zvals, ingestconn):
         t0 = time.time()
 
@@ -284,20 +781,58 @@ class EMaligner(argschema.ArgSchemaParser):
                 mat_stats(assemble_result['A'], 'A')
 
             self.ntiles_used = assemble_result['tids'].size
+            if self.args['solver']['ordering'] == 'hilbert':
+                self.tile_positions = tile_centers(
+                    assemble_result['tspecs'],
+                    assemble_result['shared_tforms'])
             logger.info(' A created in %0.1f seconds' % (time.time() - t0))
 
             if self.args['profile_data_load']:
                 raise EMalignerException(
                     "exiting after timing profile")
 
+            if self.overlap_solution is not None:
+                self.constrain_overlap(assemble_result)
+
+            solver_options = self.args['solver']
+            sweep = None
+            if (len(self.args['regularization_sweep']) != 0) & \
+                    (self.args['output_mode'] != 'hdf5'):
+                # the sweep and the solve share the sparsity pattern of K,
+                # keep a factorization for reuse of its symbolic analysis
+                solver_options = dict(
+                    solver_options,
+                    factorization_cache_size=max(
+                        1, solver_options['factorization_cache_size']))
+                # A^T W A once, for the solve and all the sweep settings
+                assemble_result['K'] = self.normal_equations(
+                    assemble_result['A'],
+                    assemble_result['weights'],
+                    assemble_result['K'])
+                sweep = self.regularization_sweep(
+                    assemble_result['A'],
+                    assemble_result['K'],
+                    assemble_result['tforms'],
+                    solver_options)
+
             # solve
             message, x, results = \
                 self.solve_or_not(
                     assemble_result['A'],
                     assemble_result['weights'],
                     assemble_result['reg'],
-                    assemble_result['tforms'])
+                    assemble_result['tforms'],
+                    K=assemble_result['K'],
+                    solver_options=solver_options)
             logger.info('\n' + message)
+            if (sweep is not None) & \
+                    (self.args['solver']['factorization_cache_size'] == 0):
+                # not kept past this solve
+                factorization_cache.clear()
+            if sweep is not None:
+                results['sweep'] = sweep
+            if self.overlap_zvals is not None:
+                self.keep_overlap_solution(assemble_result, x)
             if assemble_result['A'] is not None:
                 results['Ashape'] = assemble_result['A'].shape
             del assemble_result['A']
@@ -325,6 +860,7 @@ class EMaligner(argschema.ArgSchemaParser):
 
     assemble_struct = {
         'A': None,
+        'K': None,
         'weights': None,
         'reg': None,
         'tspecs': None,
@@ -341,7 +877,9 @@ class EMaligner(argschema.ArgSchemaParser):
             self.args['transformation'],
             zvals,
             fullsize=self.args['fullsize_transform'],
-            order=self.args['poly_order'])
+            order=self.args['poly_order'],
+            cache=self.tilespec_cache,
+            nthreads=self.args['n_load_threads'])
 
         assemble_result['shared_tforms'] = from_stack.pop('shared_tforms')
 
@@ -369,40 +907,72 @@ class EMaligner(argschema.ArgSchemaParser):
                     np.array(assemble_result['tforms']))
 
             reg = f.get('lambda')[()]
-            datafile_names = f.get('datafile_names')[()]
+            # bytes from h5py 3
+            datafile_names = np.array(
+                f.get('datafile_names')[()]).astype('U')
+            datafile_nnz = f.get('datafile_nnz')[()].ravel()
+            datafile_nrows = f.get('datafile_nrows')[()].ravel()
+            datafile_mincol = f.get('datafile_mincol')[()].ravel()
+            datafile_maxcol = f.get('datafile_maxcol')[()].ravel()
+            if 'column_tile_ids' in f.keys():
+                column_tids = np.array(
+                    f.get('column_tile_ids')[()]).astype('U')
+            else:
+                # columns for the used tiles only
+                column_tids = assemble_result['tids']
             file_args = json.loads(f.get('input_args')[()][0])
 
         # get the tile IDs and transforms
-        tile_ind = np.in1d(from_stack['tids'], assemble_result['tids'])
+        tile_ind = np.isin(from_stack['tids'], assemble_result['tids'])
         assemble_result['tspecs'] = from_stack['tspecs'][tile_ind]
 
+        # zvals can select a subset of the tiles in the files
+        ncols_per_tile = \
+            self.transform.DOF_per_tile // assemble_result['tforms'].shape[1]
+        subset = np.isin(assemble_result['tids'], from_stack['tids'])
+        if not np.all(subset):
+            logger.info(
+                " solving for %d of the %d tiles in %s" % (
+                    subset.sum(), subset.size, filename))
+            subset_cols = np.repeat(subset, ncols_per_tile)
+            assemble_result['tforms'] = \
+                assemble_result['tforms'][subset_cols, :]
+            reg = reg[subset_cols]
+            assemble_result['tids'] = assemble_result['tids'][subset]
+            assemble_result['unused_tids'] = assemble_result['unused_tids'][
+                np.isin(assemble_result['unused_tids'], from_stack['tids'])]
+        keep = np.repeat(
+            np.isin(column_tids, assemble_result['tids']), ncols_per_tile)
+
         outr = sparse.eye(reg.size, format='csr')
         outr.data = reg
         assemble_result['reg'] = outr
 
         if read_data:
-            data = np.array([]).astype('float64')
-            weights = np.array([]).astype('float64')
-            indices = np.array([]).astype('int64')
-            indptr = np.array([]).astype('int64')
-
-            fdir = os.path.dirname(filename)
-            i = 0
-            for fname in datafile_names:
-                with h5py.File(os.path.join(fdir, fname), 'r') as f:
-                    data = np.append(data, f.get('data')[()])
-                    indices = np.append(indices, f.get('indices')[()])
-                    if i == 0:
-                        indptr = np.append(indptr, f.get('indptr')[()])
-                        i += 1
-                    else:
-                        indptr = np.append(
-                            indptr,
-                            f.get('indptr')[()][1:] + indptr[-1])
-                    weights = np.append(weights, f.get('weights')[()])
-                    logger.info('  %s read' % fname)
-
-            assemble_result['A'] = csr_matrix((data, indices, indptr))
+            if not np.any(keep):
+                raise EMalignerException(
+                    "no tiles for sections %d to %d in %s" % (
+                        zvals[0], zvals[-1], filename))
+            # only the files with columns in the subset
+            cols = np.flatnonzero(keep)
+            files = \
+                (datafile_maxcol >= cols.min()) & \
+                (datafile_mincol <= cols.max())
+            data, indices, indptr, weights = read_chunk_files(
+                os.path.dirname(filename),
+                datafile_names[files],
+                datafile_nnz[files],
+                datafile_nrows[files],
+                nthreads=self.args['hdf5_options']['n_read_threads'])
+
+            if np.all(keep):
+                assemble_result['A'] = csr_matrix((data, indices, indptr))
+            else:
+                data, indices, indptr, weights = select_columns(
+                    data, indices, indptr, weights, keep)
+                assemble_result['A'] = csr_matrix(
+                    (data, indices, indptr),
+                    shape=(weights.size, np.count_nonzero(keep)))
 
             outw = sparse.eye(weights.size, format='csr')
             outw.data = weights
@@ -433,7 +1003,9 @@ class EMaligner(argschema.ArgSchemaParser):
             self.args['transformation'],
             zvals,
             fullsize=self.args['fullsize_transform'],
-            order=self.args['poly_order'])
+            order=self.args['poly_order'],
+            cache=self.tilespec_cache,
+            nthreads=self.args['n_load_threads'])
 
         assemble_result['shared_tforms'] = from_stack.pop('shared_tforms')
 
@@ -441,13 +1013,15 @@ class EMaligner(argschema.ArgSchemaParser):
         CSR_A = self.create_CSR_A(
             from_stack['tids'],
             from_stack['zvals'],
-            from_stack['sectionIds'])
+            from_stack['sectionIds'],
+            tile_zvals=np.array([t.z for t in from_stack['tspecs']]))
 
         assemble_result['A'] = CSR_A.pop('A')
+        assemble_result['K'] = CSR_A.pop('K')
         assemble_result['weights'] = CSR_A.pop('weights')
 
         # some book-keeping if there were some unused tiles
-        tile_ind = np.in1d(from_stack['tids'], CSR_A['tiles_used'])
+        tile_ind = np.isin(from_stack['tids'], CSR_A['tiles_used'])
         assemble_result['tspecs'] = from_stack['tspecs'][tile_ind]
         assemble_result['tids'] = \
             from_stack['tids'][tile_ind]
@@ -459,11 +1033,15 @@ class EMaligner(argschema.ArgSchemaParser):
             tile_ind,
             self.transform.DOF_per_tile / from_stack['tforms'].shape[1])
         if self.args['output_mode'] != 'hdf5':
-            # for large matrices,
-            # this might be expensive to perform on CSR format
-            assemble_result['A'] = assemble_result['A'][:, slice_ind]
+            # renumbered in place, no copy of A
+            assemble_result['A'] = compact_columns(
+                assemble_result['A'], slice_ind)
+            if assemble_result['K'] is not None:
+                assemble_result['K'] = compact_columns(
+                    assemble_result['K'], slice_ind, rows=True)
 
         assemble_result['tforms'] = from_stack['tforms'][slice_ind, :]
+        column_tids = from_stack['tids']
         del from_stack, CSR_A['tiles_used'], tile_ind
 
         # create the regularization vectors
@@ -479,7 +1057,8 @@ class EMaligner(argschema.ArgSchemaParser):
                 assemble_result['tforms'],
                 assemble_result['reg'],
                 assemble_result['tids'],
-                assemble_result['unused_tids'])
+                assemble_result['unused_tids'],
+                column_tids=column_tids)
 
         return assemble_result
 
@@ -500,29 +1079,43 @@ class EMaligner(argschema.ArgSchemaParser):
         return pairs
 
     def concatenate_chunks(self, chunks):
-        i = 0
-        while chunks[i]['data'] is None:
-            if i == len(chunks) - 1:
-                break
-            i += 1
-        c0 = chunks[i]
-        for c in chunks[(i + 1):]:
-            if c['data'] is not None:
-                for ckey in ['data', 'weights', 'indices', 'zlist']:
-                    c0[ckey] = np.append(c0[ckey], c[ckey])
-                ckey = 'indptr'
-                lastptr = c0[ckey][-1]
-                c0[ckey] = np.append(c0[ckey], c[ckey][1:] + lastptr)
-        return c0
-
-    def create_CSR_A(self, tile_ids, zvals, sectionIds):
+        return concatenate_chunks(chunks)
+
+    def create_CSR_A(self, tile_ids, zvals, sectionIds, tile_zvals=None):
+        # tile_zvals, the z of each tile, for incremental hdf5 output
         func_result = {
             'A': None,
+            'K': None,
             'weights': None,
             'tiles_used': None,
             'metadata': None}
 
-        pool = multiprocessing.Pool(self.args['n_parallel_jobs'])
+        scratch_dir = self.args['matrix_assembly']['scratch_dir']
+        if scratch_dir != '':
+            if not os.path.isdir(scratch_dir):
+                os.makedirs(scratch_dir)
+            # removed, with all the shared chunks, when assembly is done
+            scratch_dir = tempfile.mkdtemp(dir=scratch_dir)
+
+        incremental = \
+            (self.args['output_mode'] == 'hdf5') & \
+            self.args['hdf5_options']['incremental'] & \
+            (tile_zvals is not None)
+        reusable = {}
+        if incremental:
+            reusable = read_chunk_signatures(
+                self.args['hdf5_options']['output_dir'])
+
+        initargs = (self.args, TileIndex(tile_ids), scratch_dir)
+        if multiprocessing.current_process().daemon:
+            # a section of a parallel montage, already in a pool worker
+            pool = SerialPool(initialize_worker, initargs)
+        else:
+            pool = multiprocessing.Pool(
+                self.args['n_parallel_jobs'],
+                initializer=initialize_worker,
+                initargs=initargs,
+                maxtasksperchild=self.args['maxtasksperchild'])
 
         pairs = self.determine_zvalue_pairs(zvals, sectionIds)
 
@@ -538,70 +1131,175 @@ class EMaligner(argschema.ArgSchemaParser):
                     float(npairs) /
                     self.args['hdf5_options']['chunks_per_file']))
 
-        fargs = []
-        for i in np.arange(npairs):
-            fargs.append([
-                pairs[i],
-                i,
-                self.args,
-                tile_ids])
-        results = pool.map(calculate_processing_chunk, fargs)
-        pool.close()
+        max_in_flight = self.args['matrix_assembly']['max_chunks_in_flight']
+        results = None
+        writer = None
+        try:
+            tiles_used = []
+            file_metadata = [None] * len(proc_chunks)
+            signatures = [None] * len(proc_chunks)
+            nreused = 0
+            todo = np.arange(npairs)
+            if incremental:
+                # files with the same signature as in an earlier run
+                # are kept, their section pairs are not assembled
+                signatures = pool.map(calculate_file_signature, [[
+                    [pairs[i] for i in pchunk],
+                    tile_columns_key(
+                        tile_ids,
+                        tile_zvals,
+                        [pairs[i]['z1'] for i in pchunk] +
+                        [pairs[i]['z2'] for i in pchunk])]
+                    for pchunk in proc_chunks])
+                todo = []
+                for ifile, pchunk in enumerate(proc_chunks):
+                    if signatures[ifile] in reusable:
+                        reused = reusable[signatures[ifile]]
+                        file_metadata[ifile] = reused['metadata']
+                        tiles_used += reused['tiles_used']
+                        nreused += 1
+                    else:
+                        todo.append(pchunk)
+                todo = np.concatenate([[]] + todo).astype('int')
+
+            # file of each section pair, and the last pair of each file
+            pair_file = np.zeros(npairs, dtype='int')
+            for ifile, pchunk in enumerate(proc_chunks):
+                pair_file[pchunk] = ifile
+            file_ends = set([
+                pchunk[-1] for pchunk in proc_chunks if pchunk.size != 0])
+
+            pairs_per_query = \
+                self.args['matrix_assembly']['pairs_per_query']
+            if pairs_per_query > 1:
+                # blocks of section pairs, one point match query for each
+                blocks = np.array_split(
+                    todo,
+                    max(1, np.ceil(float(todo.size) / pairs_per_query)))
+                fargs = []
+                for block in blocks:
+                    fargs.append([
+                        [pairs[i] for i in block],
+                        block])
+                func = calculate_processing_block
+            else:
+                fargs = []
+                for i in todo:
+                    fargs.append([pairs[i], i])
+                func = calculate_processing_chunk
+
+            if max_in_flight > 0:
+                # streamed, in order, as the tasks finish
+                results = imap_bounded(pool, func, fargs, max_in_flight)
+            else:
+                results = pool.map(func, fargs)
+            pool.close()
+
+            if self.args['output_mode'] == 'hdf5':
+                # files are written, compressed, from threads here
+                # while the pool assembles the next section pairs
+                nwriters = self.args['n_parallel_jobs']
+                writer = ThreadPool(nwriters)
+                writes = collections.deque()
+
+            if max_in_flight > 0:
+                cbuf = ChunkBuffer()
+            else:
+                cbuf = None
+
+            normal_equations = use_normal_equations(self.args)
+            if normal_equations:
+                # columns for every tile, the most there can be
+                Ksum = SparseSum(tile_ids.size * self.transform.DOF_per_tile)
+
+            file_chunks = []
+            file_tiles = []
+            all_chunks = []
+            ipair = 0
+            for result in results:
+                if isinstance(result, dict):
+                    result = [result]
+                for chunk in result:
+                    tiles_used += chunk['tiles_used']
+                    if normal_equations & (chunk['data'] is not None):
+                        Ksum.add(*chunk.pop('K'))
+                    if self.args['output_mode'] == 'hdf5':
+                        # each file written once its section pairs are done
+                        file_chunks.append(chunk)
+                        file_tiles += chunk['tiles_used']
+                        if todo[ipair] in file_ends:
+                            if len(writes) == nwriters:
+                                # bounded, files waiting hold their chunks
+                                ifile, write = writes.popleft()
+                                file_metadata[ifile] = write.get()
+                            ifile = pair_file[todo[ipair]]
+                            writes.append((ifile, writer.apply_async(
+                                write_file_chunks, (
+                                    file_chunks,
+                                    self.args['hdf5_options'],
+                                    signatures[ifile],
+                                    file_tiles))))
+                            file_chunks = []
+                            file_tiles = []
+                    elif cbuf is not None:
+                        cbuf.append(chunk)
+                        remove_shared_chunk(chunk)
+                    else:
+                        all_chunks.append(chunk)
+                    ipair += 1
+
+            if writer is not None:
+                for ifile, write in writes:
+                    file_metadata[ifile] = write.get()
+                writer.close()
+                writer.join()
+        except BaseException:
+            # stop the task producer first, terminate() waits for it
+            if (max_in_flight > 0) & (results is not None):
+                results.close()
+            pool.terminate()
+            if writer is not None:
+                writer.terminate()
+            if scratch_dir != '':
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+            raise
         pool.join()
-
-        tiles_used = []
-        for i in np.arange(len(results)):
-            tiles_used += results[i]['tiles_used']
         func_result['tiles_used'] = np.array(tiles_used)
+        func_result['metadata'] = [
+            m for m in file_metadata if m is not None]
+        if incremental:
+            logger.info(
+                " reused %d of %d matrix files in %s" % (
+                    nreused,
+                    len(proc_chunks),
+                    self.args['hdf5_options']['output_dir']))
 
-        func_result['metadata'] = []
-        if self.args['output_mode'] == 'hdf5':
-            results = np.array(results)
-            for pchunk in proc_chunks:
-                cat_chunk = self.concatenate_chunks(results[pchunk])
-                if cat_chunk['data'] is not None:
-                    c = csr_matrix((
-                        cat_chunk['data'],
-                        cat_chunk['indices'],
-                        cat_chunk['indptr']))
-                    fname = self.args['hdf5_options']['output_dir'] + \
-                        '/%d_%d.h5' % (
-                        cat_chunk['zlist'].min(),
-                        cat_chunk['zlist'].max())
-                    func_result['metadata'].append(
-                        write_chunk_to_file(
-                            fname,
-                            c,
-                            cat_chunk['weights']))
-
-        else:
-            data = np.concatenate([
-                results[i]['data'] for i in range(len(results))
-                if results[i]['data'] is not None]).astype('float64')
-            weights = np.concatenate([
-                results[i]['weights'] for i in range(len(results))
-                if results[i]['data'] is not None]).astype('float64')
-            indices = np.concatenate([
-                results[i]['indices'] for i in range(len(results))
-                if results[i]['data'] is not None]).astype('int64')
-            # Pointers need to be handled differently,
-            # since you need to sum the arrays
-            indptr = [results[i]['indptr']
-                      for i in range(len(results))
-                      if results[i]['data'] is not None]
-            indptr_cumends = np.cumsum([i[-1] for i in indptr])
-            indptr = np.concatenate(
-                [j if i == 0 else j[1:]+indptr_cumends[i-1] for i, j
-                 in enumerate(indptr)]).astype('int64')
-            A = csr_matrix((data, indices, indptr))
-            outw = sparse.eye(weights.size, format='csr')
-            outw.data = weights
+        if self.args['output_mode'] != 'hdf5':
+            if cbuf is None:
+                cat_chunk = self.concatenate_chunks(all_chunks)
+            else:
+                cat_chunk = cbuf.result()
+            A = csr_matrix((
+                cat_chunk['data'],
+                cat_chunk['indices'],
+                cat_chunk['indptr']))
+            outw = sparse.eye(cat_chunk['weights'].size, format='csr')
+            outw.data = cat_chunk['weights']
             func_result['A'] = A
             func_result['weights'] = outw
+            if normal_equations:
+                func_result['K'] = Ksum.result(A.shape[1])
+
+        if scratch_dir != '':
+            shutil.rmtree(scratch_dir)
 
         return func_result
 
-    def solve_or_not(self, A, weights, reg, filt_tforms):
+    def solve_or_not(
+            self, A, weights, reg, filt_tforms, K=None, solver_options=None):
+        # solver_options default to self.args['solver']
+        if solver_options is None:
+            solver_options = self.args['solver']
         t0 = time.time()
         # not
         if self.args['output_mode'] in ['hdf5']:
@@ -622,92 +1320,169 @@ class EMaligner(argschema.ArgSchemaParser):
             results = None
         else:
             # regularized least squares
-            # ensure symmetry of K
-            weights.data = np.sqrt(weights.data)
-            rtWA = weights.dot(A)
-            K = rtWA.transpose().dot(rtWA) + reg
+            K = self.normal_equations(A, weights, K) + reg
 
             logger.info(' K created in %0.1f seconds' % (time.time() - t0))
-            t0 = time.time()
-            del weights, rtWA
-
-            # factorize, then solve, efficient for large affine
-            solve = factorized(K)
-            if filt_tforms.shape[1] == 2:
-                # certain transforms have redundant matrices
-                # then applies the LU decomposition to
-                # the u and v transforms separately
-                Lm = reg.dot(filt_tforms[:, 0])
-                xu = solve(Lm)
-                erru = A.dot(xu)
-                precisionu = \
-                    np.linalg.norm(K.dot(xu) - Lm) / np.linalg.norm(Lm)
-
-                Lm = reg.dot(filt_tforms[:, 1])
-                xv = solve(Lm)
-                errv = A.dot(xv)
-                precisionv = \
-                    np.linalg.norm(K.dot(xv) - Lm) / np.linalg.norm(Lm)
-                precision = np.sqrt(precisionu ** 2 + precisionv ** 2)
-
-                # recombine
-                x = np.transpose(np.vstack((xu, xv)))
-                err = np.hstack((erru, errv))
-                del xu, xv, erru, errv, precisionu, precisionv
-            else:
-                # simpler case for similarity, or
-                # affine_fullsize, but 2x larger than affine
+            del weights
 
-                Lm = reg.dot(filt_tforms[:, 0])
-                x = solve(Lm)
-                err = A.dot(x)
-                precision = \
-                    np.linalg.norm(K.dot(x) - Lm) / np.linalg.norm(Lm)
-            del K, Lm
+            message, x, results = self.solve_regularized(
+                A, K, reg, filt_tforms, solver_options)
 
-            error = np.linalg.norm(err)
+        return message, x, results
 
-            results = {}
-            results['time'] = time.time()-t0
-            results['precision'] = precision
-            results['error'] = error
-            results['err'] = [np.abs(err).mean(), np.abs(err).std()]
-
-            message = ' solved in %0.1f sec\n' % (time.time() - t0)
-            message += (
-                " precision [norm(Kx-Lm)/norm(Lm)] "
-                "= %0.1e\n" % precision)
-            message += (
-                " error     [norm(Ax-b)] "
-                "= %0.3f\n" % error)
-            message += (
-                " [mean(|Ax|)+/-std(|Ax|)] : "
-                "%0.1f +/- %0.1f pixels" % (
-                    np.abs(err).mean(),
-                    np.abs(err).std()))
-
-            # get the scales (quick way to look for distortion)
-            tforms = self.transform.from_solve_vec(x)
-            if isinstance(
-                    self.transform,
-                    renderapi.transform.Polynomial2DTransform):
-                # renderapi does not have scale property
-                if self.transform.order > 0:
-                    scales = np.array(
-                        [[t.params[0, 1], t.params[1, 2]]
-                         for t in tforms]).flatten()
-                else:
-                    scales = np.array([0])
+    def normal_equations(self, A, weights, K=None):
+        # A^T W A, in CSC
+        if K is not None:
+            # summed from the assembly workers
+            return K.tocsc()
+        # ensure symmetry of K
+        weights.data = np.sqrt(weights.data)
+        rtWA = weights.dot(A)
+        return rtWA.transpose().dot(rtWA)
+
+    def solve_regularized(self, A, K, reg, filt_tforms, solver_options):
+        t0 = time.time()
+        # factorize, then solve, efficient for large affine
+        block_size = self.transform.DOF_per_tile // filt_tforms.shape[1]
+        halves = None
+        if (isinstance(self.transform, AlignerAffineModel) and
+                self.transform.fullsize and solver_options['split_uv']):
+            halves = uv_halves(K, block_size)
+        if halves is not None:
+            block_size = block_size // 2
+        solver = make_solver(
+            solver_options,
+            block_size=block_size,
+            tile_positions=self.tile_positions)
+        if halves is None:
+            solver.factorize(K)
+        else:
+            solver.factorize(halves[2])
+        solve = solver.solve
+        if filt_tforms.shape[1] == 2:
+            # certain transforms have redundant matrices
+            # then applies the LU decomposition to
+            # the u and v transforms, as 2 right-hand sides
+            Lm = reg.dot(filt_tforms)
+            x = solve(Lm, filt_tforms)
+            precision = []
+            err = []
+            for i in range(2):
+                err.append(A.dot(x[:, i]))
+                precision.append(
+                    np.linalg.norm(K.dot(x[:, i]) - Lm[:, i]) /
+                    np.linalg.norm(Lm[:, i]))
+            precision = np.sqrt(precision[0] ** 2 + precision[1] ** 2)
+            err = np.hstack(err)
+        else:
+            # simpler case for similarity, or
+            # affine_fullsize, but 2x larger than affine
+
+            Lm = reg.dot(filt_tforms[:, 0])
+            if halves is None:
+                x = solve(Lm, filt_tforms[:, 0])
             else:
-                scales = np.array([
-                    np.array(t.scale) for t in tforms]).flatten()
+                # same K for u and v, as 2 right-hand sides
+                i0, i1 = halves[0:2]
+                xh = solve(
+                    np.transpose([Lm[i0], Lm[i1]]),
+                    np.transpose([filt_tforms[i0, 0], filt_tforms[i1, 0]]))
+                x = np.zeros(Lm.size)
+                x[i0] = xh[:, 0]
+                x[i1] = xh[:, 1]
+            err = A.dot(x)
+            precision = \
+                np.linalg.norm(K.dot(x) - Lm) / np.linalg.norm(Lm)
+        del K, Lm, halves
+
+        error = np.linalg.norm(err)
+
+        results = {}
+        results['time'] = time.time()-t0
+        results['precision'] = precision
+        results['error'] = error
+        results['err'] = [np.abs(err).mean(), np.abs(err).std()]
+        results['solver'] = solver.report
+        if 'iterations' in solver.report:
+            results['iterations'] = solver.report['iterations']
+
+        message = ' solved in %0.1f sec\n' % (time.time() - t0)
+        message += (
+            " precision [norm(Kx-Lm)/norm(Lm)] "
+            "= %0.1e\n" % precision)
+        message += (
+            " error     [norm(Ax-b)] "
+            "= %0.3f\n" % error)
+        message += (
+            " [mean(|Ax|)+/-std(|Ax|)] : "
+            "%0.1f +/- %0.1f pixels" % (
+                np.abs(err).mean(),
+                np.abs(err).std()))
+        message += '\n' + solver.message()
+
+        # get the scales (quick way to look for distortion)
+        tforms = self.transform.from_solve_vec(x)
+        if isinstance(
+                self.transform,
+                renderapi.transform.Polynomial2DTransform):
+            # renderapi does not have scale property
+            if self.transform.order > 0:
+                scales = np.array(
+                    [[t.params[0, 1], t.params[1, 2]]
+                     for t in tforms]).flatten()
+            else:
+                scales = np.array([0])
+        else:
+            scales = np.array([
+                np.array(t.scale) for t in tforms]).flatten()
 
-            results['scale'] = scales.mean()
-            message += '\n avg scale = %0.2f +/- %0.2f' % (
-                scales.mean(), scales.std())
+        results['scale'] = scales.mean()
+        message += '\n avg scale = %0.2f +/- %0.2f' % (
+            scales.mean(), scales.std())
 
         return message, x, results
 
+    def regularization_sweep(self, A, K, filt_tforms, solver_options=None):
+        # solve for each of the regularization_sweep settings
+        # K = A^T W A is shared, only the diagonal regularization changes
+        if solver_options is None:
+            solver_options = self.args['solver']
+        table = []
+        for setting in self.args['regularization_sweep']:
+            reg = self.transform.create_regularization(
+                filt_tforms.shape[0], setting)
+            message, x, results = self.solve_regularized(
+                A, K + reg, reg, filt_tforms, solver_options)
+            row = {
+                'default_lambda': setting['default_lambda'],
+                'translation_factor': setting['translation_factor'],
+                'poly_factors': setting['poly_factors'],
+                'precision': results['precision'],
+                'error': results['error'],
+                'err': results['err'],
+                'scale': results['scale'],
+                'time': results['solver']['factor_time'] +
+                results['solver']['solve_time']}
+            table.append(row)
+
+        message = ' regularization sweep\n'
+        message += '%10s %10s %10s %10s %10s %10s %8s %8s\n' % (
+            'lambda', 'transfac', 'precision', 'error',
+            'mean|Ax|', 'std|Ax|', 'scale', 'sec')
+        for row in table:
+            message += \
+                '%10.3g %10.3g %10.1e %10.3f %10.2f %10.2f %8.4f %8.2f\n' % (
+                    row['default_lambda'],
+                    row['translation_factor'],
+                    row['precision'],
+                    row['error'],
+                    row['err'][0],
+                    row['err'][1],
+                    row['scale'],
+                    row['time'])
+        logger.info(message)
+        return table
+
 
 if __name__ == '__main__':
     mod = EMaligner(schema_type=EMA_Schema)
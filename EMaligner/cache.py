@@ -0,0 +1,301 @@
+import numpy as np
+import renderapi
+import copy
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from .utils import (
+        make_dbconnection,
+        get_matches,
+        get_matches_for_pairs,
+        get_z_tilespecs)
+from .transform.utils import MatchArrays
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache(object):
+    """a directory of .npz files, evicted least recently used first
+    when the total size exceeds max_size_GB"""
+
+    def __init__(self, cache_dir, max_size_GB=10.0):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_GB * 2.0**30
+        # running estimate of the size on disk, so that the directory
+        # is only scanned when eviction is likely needed
+        self.size = None
+
+    def path(self, subdir, key):
+        h = hashlib.sha1(
+                json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, subdir, h + '.npz')
+
+    def load(self, fname):
+        try:
+            with np.load(fname, allow_pickle=False) as f:
+                arrays = {k: f[k] for k in f.files}
+            # mark as recently used
+            os.utime(fname, None)
+        except (IOError, OSError, ValueError):
+            # missing, or being evicted by another process
+            return None
+        return arrays
+
+    def save(self, fname, compress=False, **arrays):
+        fdir = os.path.dirname(fname)
+        if not os.path.isdir(fdir):
+            try:
+                os.makedirs(fdir)
+            except OSError:
+                # another worker made it
+                pass
+        # write to a temporary file, then move, so other processes
+        # never read a partial file
+        fd, tmpname = tempfile.mkstemp(dir=fdir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            if compress:
+                np.savez_compressed(f, **arrays)
+            else:
+                np.savez(f, **arrays)
+        os.rename(tmpname, fname)
+
+        if self.size is None:
+            self.size = self.scan()[1]
+        else:
+            self.size += os.path.getsize(fname)
+        if self.size > self.max_size:
+            self.evict()
+
+    def scan(self):
+        files = []
+        for root, dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith('.npz'):
+                    continue
+                fname = os.path.join(root, name)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, fname))
+        return files, sum(f[1] for f in files)
+
+    def evict(self):
+        files, total = self.scan()
+        for mtime, size, fname in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(fname)
+                logger.debug('evicted %s from cache' % fname)
+            except OSError:
+                pass
+            total -= size
+        self.size = total
+
+
+# render pair counts by host and owner, listed once per run
+render_pair_counts = {}
+
+
+def get_render_pair_counts(collection, dbconnection):
+    key = (collection['host'], collection['port'], collection['owner'])
+    if key not in render_pair_counts:
+        counts = {}
+        for c in renderapi.pointmatch.get_matchcollections(
+                owner=collection['owner'],
+                render=dbconnection):
+            counts[c['collectionId']['name']] = c['pairCount']
+        render_pair_counts[key] = counts
+    return render_pair_counts[key]
+
+
+def match_signature(iId, jId, collection, dbconnection):
+    # changes when the point matches of a section pair change
+    # with mongo, a hash of the ids of the pair's documents, which are
+    # new when the pair is matched again. Render only reports pair
+    # counts for the whole collection, a change anywhere changes them
+    if collection['db_interface'] == 'render':
+        counts = get_render_pair_counts(collection, dbconnection)
+        return json.dumps(
+                [counts.get(name, -1) for name in collection['name']])
+    h = hashlib.sha1()
+    if collection['db_interface'] == 'mongo':
+        clauses = [{'pGroupId': iId, 'qGroupId': jId}]
+        if iId != jId:
+            clauses.append({'pGroupId': jId, 'qGroupId': iId})
+        for dbconn in dbconnection:
+            ids = sorted(
+                    str(d['_id'])
+                    for d in dbconn.find({'$or': clauses}, {'_id': True}))
+            h.update(json.dumps(ids).encode('utf-8'))
+    return h.hexdigest()
+
+
+class MatchCache(DiskCache):
+    """point matches per section pair, keyed by
+    pointmatch owner, collection names and groupIds"""
+
+    fields = [
+            'pId', 'qId', 'pGroupId', 'qGroupId', 'offsets', 'p', 'q', 'w']
+
+    # one instance per process and cache_dir
+    instances = {}
+
+    def __init__(self, cache_dir, max_size_GB=10.0, validate=True):
+        super(MatchCache, self).__init__(cache_dir, max_size_GB)
+        self.validate = validate
+
+    @classmethod
+    def from_args(cls, cache_args):
+        if cache_args['cache_dir'] == '':
+            return None
+        key = (
+                cache_args['cache_dir'],
+                cache_args['max_size_GB'],
+                cache_args['validate_matches'])
+        if key not in cls.instances:
+            cls.instances[key] = cls(
+                    cache_args['cache_dir'],
+                    max_size_GB=cache_args['max_size_GB'],
+                    validate=cache_args['validate_matches'])
+        return cls.instances[key]
+
+    def lookup(self, iId, jId, collection, dbconnection):
+        # returns cached MatchArrays, or None, and the current signature
+        signature = np.zeros(0).astype('int64')
+        if self.validate:
+            signature = match_signature(iId, jId, collection, dbconnection)
+
+        cached = self.load(self.pair_path(iId, jId, collection))
+        if cached is not None:
+            if (not self.validate) | \
+                    np.array_equal(cached['signature'], signature):
+                logger.debug(
+                    'cached matches for groupIds %s and %s' % (iId, jId))
+                return (
+                    MatchArrays(**{k: cached[k] for k in self.fields}),
+                    signature)
+        return None, signature
+
+    def pair_path(self, iId, jId, collection):
+        return self.path(
+                'pointmatch',
+                [collection['owner'], collection['name'], iId, jId])
+
+    def store(self, iId, jId, collection, matches, signature):
+        self.save(
+                self.pair_path(iId, jId, collection),
+                signature=signature,
+                **{k: getattr(matches, k) for k in self.fields})
+
+    def get_matches(self, iId, jId, collection, dbconnection):
+        matches, signature = self.lookup(iId, jId, collection, dbconnection)
+        if matches is None:
+            matches = get_matches(
+                    iId, jId, collection, dbconnection, as_arrays=True)
+            self.store(iId, jId, collection, matches, signature)
+        return matches
+
+    def get_matches_for_pairs(self, pairs, collection, dbconnection):
+        found = [
+                self.lookup(iId, jId, collection, dbconnection)
+                for iId, jId in pairs]
+        matches = [f[0] for f in found]
+
+        # one query for all the pairs not in the cache
+        missing = [k for k in range(len(pairs)) if matches[k] is None]
+        fetched = get_matches_for_pairs(
+                [pairs[k] for k in missing], collection, dbconnection)
+        for k, m in zip(missing, fetched):
+            self.store(pairs[k][0], pairs[k][1], collection, m, found[k][1])
+            matches[k] = m
+        return matches
+
+
+class TileSpecCache(DiskCache):
+    """tile specs, shared transforms and sectionId per z, keyed by
+    stack and z. Invalidated by the stack lastModifiedTimestamp"""
+
+    def __init__(self, cache_dir, max_size_GB=10.0):
+        super(TileSpecCache, self).__init__(cache_dir, max_size_GB)
+        self.timestamps = {}
+        # z values can be loaded from several threads
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, cache_args):
+        if (cache_args['cache_dir'] == '') | \
+                (not cache_args['cache_tilespecs']):
+            return None
+        return cls(
+                cache_args['cache_dir'],
+                max_size_GB=cache_args['max_size_GB'])
+
+    def stack_key(self, stack):
+        return [stack['owner'], stack['project'], stack['name'][0]]
+
+    def timestamp(self, stack):
+        # requested once per stack for the life of this object
+        # EMaligner.run() makes a new TileSpecCache each run
+        # stack metadata always comes from render, as in EMaligner.run()
+        key = json.dumps(self.stack_key(stack))
+        with self.lock:
+            if key not in self.timestamps:
+                self.timestamps[key] = self.request_timestamp(stack)
+        return self.timestamps[key]
+
+    def request_timestamp(self, stack):
+        render_stack = copy.deepcopy(stack)
+        render_stack['db_interface'] = 'render'
+        try:
+            meta = renderapi.stack.get_full_stack_metadata(
+                    stack['name'][0],
+                    owner=stack['owner'],
+                    project=stack['project'],
+                    render=make_dbconnection(render_stack))
+        except Exception as e:
+            logger.warning(
+                'no stack modification time for %s, '
+                'not using tile spec cache: %s' % (stack['name'][0], e))
+            return None
+        return str(meta['lastModifiedTimestamp'])
+
+    def get_tilespecs(
+            self, stack, z, dbconnection, transform_dbconnection=None,
+            session=None):
+        timestamp = self.timestamp(stack)
+        if timestamp is None:
+            return get_z_tilespecs(
+                    stack, z, dbconnection, transform_dbconnection,
+                    session=session)
+
+        fname = self.path('tilespec', self.stack_key(stack) + [float(z)])
+        cached = self.load(fname)
+        if cached is not None:
+            if str(cached['timestamp']) == timestamp:
+                c = json.loads(str(cached['json']))
+                tspecs = [
+                        renderapi.tilespec.TileSpec(json=t)
+                        for t in c['tilespecs']]
+                shared_tforms = [
+                        renderapi.transform.load_transform_json(t)
+                        for t in c['shared_tforms']]
+                return tspecs, shared_tforms, c['sectionId']
+
+        tspecs, shared_tforms, sectionId = get_z_tilespecs(
+                stack, z, dbconnection, transform_dbconnection,
+                session=session)
+        c = {
+                'tilespecs': [t.to_dict() for t in tspecs],
+                'shared_tforms': [t.to_dict() for t in shared_tforms],
+                'sectionId': sectionId}
+        self.save(
+                fname,
+                compress=True,
+                timestamp=np.array(timestamp),
+                json=np.array(json.dumps(c)))
+        return tspecs, shared_tforms, sectionId
@@ -71,6 +71,37 @@ class hdf5_options(ArgSchema):
         default=5,
         description=("how many sections with upward-looking"
                      " cross section to write per .h5 file"))
+    n_read_threads = Int(
+        default=4,
+        description=("threads reading matrix files for "
+                     "assemble_from_file"))
+    compression = String(
+        default='none',
+        validate=lambda x: x in ['none', 'gzip', 'lzf', 'blosc'],
+        description=("compression filter for the matrix files. lzf is "
+                     "only readable through h5py, blosc needs hdf5plugin "
+                     "to write and read. Check what the external solver "
+                     "can read"))
+    compression_level = Int(
+        default=4,
+        description='compression level for gzip and blosc')
+    chunk_size = Int(
+        default=2**20,
+        description='hdf5 chunk length for compressed datasets')
+    narrow_indices = Boolean(
+        default=False,
+        description=("write indices and indptr with the narrowest "
+                     "integer type that holds them, instead of int64"))
+    incremental = Boolean(
+        default=False,
+        description=("reuse matrix files in output_dir written by an "
+                     "earlier incremental run, when the point match "
+                     "documents of their section pairs, their tile "
+                     "columns and the assembly settings are unchanged. "
+                     "Files are rewritten otherwise. Point matches are "
+                     "compared by document ids, new when a pair is "
+                     "matched again, so only for a mongo pointmatch "
+                     "db_interface"))
 
 
 class matrix_assembly(ArgSchema):
@@ -127,6 +158,53 @@ class matrix_assembly(ArgSchema):
         default=True,
         required=False,
         description='cross section point match weighting fades with z')
+    pairs_per_query = Int(
+        default=1,
+        required=False,
+        description=("section pairs per assembly task, with point matches "
+                     "fetched by one mongo query per collection for all "
+                     "of them. 1 for one query per section pair"))
+    scratch_dir = String(
+        default='',
+        required=False,
+        description=("directory where workers write assembled chunks, "
+                     "read back memory-mapped by the parent process. "
+                     "Empty string to return chunks through the pool"))
+    max_chunks_in_flight = Int(
+        default=0,
+        required=False,
+        description=("stream assembly results, with at most this many "
+                     "tasks running or waiting to be consumed. "
+                     "0 to collect all the results at once"))
+    normal_equations = Boolean(
+        default=False,
+        required=False,
+        description=("workers also compute their chunk's part of "
+                     "K = A^T W A, summed by the parent instead of "
+                     "forming W A and its transpose for the solve"))
+
+
+class cache_options(ArgSchema):
+    cache_dir = String(
+        default='',
+        description=("directory for a local cache of point matches "
+                     "and tile specs, reused across runs. "
+                     "empty string for no cache"))
+    max_size_GB = Float(
+        default=10.0,
+        description=("least recently used files are removed when the "
+                     "cache exceeds this size"))
+    validate_matches = Boolean(
+        default=True,
+        description=("check the database for changed point matches "
+                     "before using cached matches: document ids of the "
+                     "section pair with mongo, pair counts of the whole "
+                     "collection with render. False skips the database "
+                     "entirely for cached section pairs"))
+    cache_tilespecs = Boolean(
+        default=True,
+        description=("also cache tile specs and shared transforms per z. "
+                     "checked against the stack modification time"))
 
 
 class regularization(ArgSchema):
@@ -150,6 +228,10 @@ class regularization(ArgSchema):
         required=False)
 
 
+# EMA_Schema has a field of the same name
+RegularizationSchema = regularization
+
+
 class pointmatch(db_params):
     collection_type = String(
         default='pointmatch',
@@ -171,6 +253,76 @@ class stack(db_params):
                                   "stack name is allowed")
 
 
+class solver_options(ArgSchema):
+    backend = String(
+        default='lu',
+        required=False,
+        validate=lambda x: x in ['lu', 'cholmod', 'cg'],
+        description=("lu (SuperLU), cholmod (sparse Cholesky, needs "
+                     "scikit-sparse) or cg (conjugate gradients)"))
+    preconditioner = String(
+        default='jacobi',
+        required=False,
+        validate=lambda x: x in ['none', 'jacobi', 'block_jacobi', 'ilu'],
+        description=("preconditioner for cg. block_jacobi inverts the "
+                     "block of each tile. ilu is an incomplete LU with "
+                     "symmetric ordering, standing in for incomplete "
+                     "Cholesky"))
+    tolerance = Float(
+        default=1e-10,
+        required=False,
+        description='relative residual tolerance for cg')
+    max_iterations = Int(
+        default=None,
+        required=False,
+        missing=None,
+        description='iteration limit for cg. None for the scipy default')
+    warm_start = Boolean(
+        default=True,
+        required=False,
+        description='start cg from the input transforms')
+    drop_tolerance = Float(
+        default=1e-4,
+        required=False,
+        description='drop tolerance for the ilu preconditioner')
+    fill_factor = Float(
+        default=10.0,
+        required=False,
+        description='fill factor limit for the ilu preconditioner')
+    split_uv = Boolean(
+        default=True,
+        required=False,
+        description=("for fullsize affine, check whether the u and v "
+                     "halves of K are the same and uncoupled. If so, "
+                     "factorize one half and solve u and v as 2 "
+                     "right-hand sides"))
+    ordering = String(
+        default='none',
+        required=False,
+        validate=lambda x: x in ['none', 'rcm', 'hilbert'],
+        description=("reorder tiles before factorizing, for less fill. "
+                     "rcm (reverse Cuthill-McKee on the tile graph) or "
+                     "hilbert (Hilbert curve through tile centers, then "
+                     "z). Solutions are returned in the original order"))
+    split_components = Boolean(
+        default=False,
+        required=False,
+        description=("solve each connected component of the tile graph "
+                     "on its own. Tiles with no point matches are solved "
+                     "without factorization"))
+    n_threads = Int(
+        default=1,
+        required=False,
+        description=("threads for factorizing and solving components "
+                     "with split_components"))
+    factorization_cache_size = Int(
+        default=0,
+        required=False,
+        description=("number of factorizations kept in memory for reuse "
+                     "by later solves of the same K, or of a K with the "
+                     "same sparsity pattern. 0 for none"))
+
+
 class EMA_Schema(ArgSchema):
     first_section = Int(
         required=True,
@@ -182,10 +334,49 @@ class EMA_Schema(ArgSchema):
         default=4,
         required=False,
         description='number of parallel jobs that will run for assembly')
+    maxtasksperchild = Int(
+        default=None,
+        required=False,
+        missing=None,
+        description=('number of assembly tasks a worker process runs '
+                     'before it is replaced. None for no limit'))
+    n_parallel_sections = Int(
+        default=1,
+        required=False,
+        description=('montage: number of sections loaded, assembled, '
+                     'solved and ingested at the same time, one per '
+                     'process. Assembly within a section is then serial. '
+                     '1 for one section at a time, each assembled by '
+                     'n_parallel_jobs processes. Not for hdf5 output'))
+    n_load_threads = Int(
+        default=4,
+        required=False,
+        description='number of z values to load tile specs for concurrently')
     solve_type = String(
         default='montage',
         required=False,
         description='Solve type options (montage, 3D) Default=montage')
+    window_size = Int(
+        default=0,
+        required=False,
+        description=('3D: solve this many sections at a time, in '
+                     'overlapping windows, to bound memory by the window '
+                     'size. 0 to solve the whole range at once'))
+    window_overlap = Int(
+        default=2,
+        required=False,
+        description=('3D windows: sections shared with the previous '
+                     'window. Their tiles start from, and are '
+                     'regularized towards, the previous solution, which '
+                     'their new solution replaces. Must be at least the '
+                     'largest matrix_assembly depth, for all the section '
+                     'pairs to be in some window'))
+    window_overlap_factor = Float(
+        default=1e3,
+        required=False,
+        description=('3D windows: multiplies the regularization of tiles '
+                     'shared with the previous window. Large values fix '
+                     'them to the previous solution'))
     close_stack = Boolean(
         default=True,
         required=False,
@@ -223,9 +414,19 @@ class EMA_Schema(ArgSchema):
     input_stack = Nested(stack)
     output_stack = Nested(stack)
     pointmatch = Nested(pointmatch)
-    hdf5_options = Nested(hdf5_options)
+    hdf5_options = Nested(hdf5_options, default={})
     matrix_assembly = Nested(matrix_assembly)
-    regularization = Nested(regularization)
+    regularization = Nested(RegularizationSchema)
+    regularization_sweep = List(
+        Nested(RegularizationSchema),
+        cli_as_single_argument=True,
+        default=[],
+        required=False,
+        description=("more regularization settings, each solved "
+                     "with the same A^T W A as the main solve. Results "
+                     "are reported in a table"))
+    cache = Nested(cache_options, default={})
+    solver = Nested(solver_options, default={})
     showtiming = Int(
         default=1,
         description='have the routine showhow long each process takes')
@@ -235,13 +436,43 @@ class EMA_Schema(ArgSchema):
 
     @post_load
     def validate_data(self, data):
-        if (data['regularization']['poly_factors'] is not None) & \
-                (data['transformation'] == 'Polynomial2DTransform'):
-            n = len(data['regularization']['poly_factors'])
-            if n != data['poly_order'] + 1:
+        for reg in [data['regularization']] + data['regularization_sweep']:
+            if (reg['poly_factors'] is not None) & \
+                    (data['transformation'] == 'Polynomial2DTransform'):
+                n = len(reg['poly_factors'])
+                if n != data['poly_order'] + 1:
+                    raise ValidationError(
+                            "regularization.poly_factors must be a list"
+                            " of length poly_order + 1")
+        if (data['n_parallel_sections'] > 1) & \
+                (data['solve_type'] == 'montage') & \
+                (data['output_mode'] == 'hdf5'):
+            raise ValidationError(
+                    "montage sections solved in parallel would all write "
+                    "solution_input.h5 in the same output_dir. Use "
+                    "n_parallel_sections = 1 for hdf5 output")
+        if (data['output_mode'] == 'hdf5') & \
+                data.get('hdf5_options', {}).get('incremental', False) & \
+                (data['pointmatch']['db_interface'] == 'render'):
+            raise ValidationError(
+                    "hdf5_options.incremental needs point match document "
+                    "ids, which render does not provide. Use a mongo "
+                    "pointmatch db_interface, or set it to False")
+        if (data['window_size'] > 0) & (data['solve_type'] == '3D'):
+            if data['window_overlap'] >= data['window_size']:
+                raise ValidationError(
+                        "window_overlap must be less than window_size")
+            if ('matrix_assembly' in data) and \
+                    (data['window_overlap'] <
+                     max(data['matrix_assembly']['depth'])):
+                raise ValidationError(
+                        "window_overlap must be at least the largest "
+                        "matrix_assembly depth, for all the section "
+                        "pairs to be in some window")
+            if data['output_mode'] == 'hdf5':
                 raise ValidationError(
-                        "regularization.poly_factors must be a list"
-                        " of length poly_order + 1")
+                        "3D windows are solved one at a time, "
+                        "and are not written to hdf5 files")
 
 
 class EMA_PlotSchema(EMA_Schema):
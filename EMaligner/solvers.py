@@ -0,0 +1,601 @@
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.linalg import splu, spilu, cg, LinearOperator
+from scipy.sparse.csgraph import connected_components, \
+    reverse_cuthill_mckee
+from .utils import EMalignerException
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import hashlib
+import logging
+import threading
+import time
+import sys
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+try:
+    from sksparse.cholmod import cholesky, analyze
+except ImportError:
+    cholesky = None
+    analyze = None
+
+logger = logging.getLogger(__name__)
+
+
+def peak_memory_GB():
+    # peak resident memory of this process so far
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on mac, kB elsewhere
+        return maxrss / 2.0**30
+    return maxrss / 2.0**20
+
+
+def sparse_GB(*matrices):
+    # memory held by the arrays of sparse matrices
+    nbytes = 0
+    for m in matrices:
+        nbytes += m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
+    return nbytes / 2.0**30
+
+
+class FactorizationCache(object):
+    """recently used factorizations, keyed by a hash of the sparsity
+    pattern of K and a hash of its values. Symbolic analyses are kept
+    by pattern only, for refactorizing when only the values change"""
+
+    def __init__(self):
+        self.symbolic = OrderedDict()
+        self.numeric = OrderedDict()
+        # components can be factorized in threads
+        self.lock = threading.Lock()
+
+    def get(self, table, key):
+        with self.lock:
+            entries = getattr(self, table)
+            if key not in entries:
+                return None
+            # now the most recently used
+            entries[key] = entries.pop(key)
+            return entries[key]
+
+    def put(self, table, key, value, size):
+        with self.lock:
+            entries = getattr(self, table)
+            entries.pop(key, None)
+            entries[key] = value
+            while len(entries) > size:
+                entries.popitem(last=False)
+
+    def clear(self):
+        self.symbolic.clear()
+        self.numeric.clear()
+
+
+# shared by all the solves in this process
+factorization_cache = FactorizationCache()
+
+
+def matrix_hashes(K, prefix=''):
+    # hash of the sparsity pattern, and of the pattern and values
+    pattern = hashlib.sha1(prefix.encode('utf-8'))
+    pattern.update(np.array(K.shape).astype('int64').tobytes())
+    pattern.update(np.ascontiguousarray(K.indptr).tobytes())
+    pattern.update(np.ascontiguousarray(K.indices).tobytes())
+    values = pattern.copy()
+    values.update(np.ascontiguousarray(K.data).tobytes())
+    return pattern.hexdigest(), values.hexdigest()
+
+
+class Solver(object):
+    """prepares K once with factorize(), then solves K x = b
+    for as many right-hand sides as needed. block_size is the number
+    of columns per tile"""
+
+    # attributes that hold the factorization, for the cache
+    state = []
+
+    # whether _solve takes several right-hand sides at once
+    multiple_rhs = True
+
+    def __init__(self, options, block_size=1):
+        self.options = options
+        self.block_size = block_size
+        self.report = {
+            'backend': self.name,
+            'factor_time': 0.0,
+            'solve_time': 0.0,
+            'factor_GB': None,
+            'peak_GB': None,
+            'reused': None}
+
+    def cache_key(self):
+        # options the factorization depends on
+        return '%s %s %s %s %s' % (
+            self.name,
+            self.options['preconditioner'],
+            self.options['drop_tolerance'],
+            self.options['fill_factor'],
+            self.block_size)
+
+    def factorize(self, K):
+        t0 = time.time()
+        K = sparse.csc_matrix(K)
+        size = self.options['factorization_cache_size']
+        if size > 0:
+            K.sum_duplicates()
+            pattern, values = matrix_hashes(K, self.cache_key())
+            cached = factorization_cache.get('numeric', values)
+            if cached is not None:
+                for k in self.state:
+                    setattr(self, k, cached[k])
+                self.report['factor_GB'] = cached['factor_GB']
+                self.report['reused'] = 'numeric'
+            else:
+                symbolic = factorization_cache.get('symbolic', pattern)
+                if symbolic is not None:
+                    self.report['reused'] = 'symbolic'
+                symbolic = self._factorize(K, symbolic)
+                factorization_cache.put('symbolic', pattern, symbolic, size)
+                cached = {k: getattr(self, k) for k in self.state}
+                cached['factor_GB'] = self.report['factor_GB']
+                factorization_cache.put('numeric', values, cached, size)
+        else:
+            self._factorize(K, None)
+        self.report['factor_time'] = time.time() - t0
+        self.report['peak_GB'] = peak_memory_GB()
+
+    def solve(self, b, x0=None):
+        # b can have a column for each of several right-hand sides
+        # x0, a starting guess, is only used by iterative backends
+        t0 = time.time()
+        if (np.ndim(b) == 2) & (not self.multiple_rhs):
+            x = np.transpose([
+                self._solve(b[:, i], None if x0 is None else x0[:, i])
+                for i in range(b.shape[1])])
+        else:
+            x = self._solve(b, x0)
+        self.report['solve_time'] += time.time() - t0
+        self.report['peak_GB'] = peak_memory_GB()
+        return x
+
+    def message(self):
+        r = self.report
+        message = ' solver %s: factorized in %0.1f sec, ' \
+            'solved in %0.1f sec' % (
+                r['backend'], r['factor_time'], r['solve_time'])
+        if r['factor_GB'] is not None:
+            message += ', factor %0.2f GB' % r['factor_GB']
+        if r['peak_GB'] is not None:
+            message += ', peak memory %0.2f GB' % r['peak_GB']
+        if r['reused'] is not None:
+            message += ', reused %s factorization' % r['reused']
+        return message
+
+
+class LUSolver(Solver):
+    """SuperLU, as scipy.sparse.linalg.factorized"""
+
+    name = 'lu'
+    state = ['lu', 'perm']
+
+    def _factorize(self, K, symbolic):
+        # symbolic is a column ordering, from a K with the same pattern
+        if symbolic is None:
+            self.lu = splu(K)
+            self.perm = None
+            symbolic = np.argsort(self.lu.perm_c)
+        else:
+            self.lu = splu(K[:, symbolic], permc_spec='NATURAL')
+            self.perm = symbolic
+        self.report['factor_GB'] = sparse_GB(self.lu.L, self.lu.U)
+        return symbolic
+
+    def _solve(self, b, x0):
+        x = self.lu.solve(b)
+        if self.perm is not None:
+            # solved for the reordered columns
+            y = np.empty_like(x)
+            y[self.perm] = x
+            x = y
+        return x
+
+
+class CholmodSolver(Solver):
+    """sparse Cholesky from scikit-sparse, for symmetric positive
+    definite K"""
+
+    name = 'cholmod'
+    state = ['factor']
+
+    def _factorize(self, K, symbolic):
+        # symbolic is a CHOLMOD analysis, for the pattern of K
+        if symbolic is None:
+            symbolic = analyze(K)
+        self.factor = symbolic.cholesky(K)
+        return symbolic
+
+    def _solve(self, b, x0):
+        return self.factor(b)
+
+
+class CGSolver(Solver):
+    """preconditioned conjugate gradients, no factorization of K"""
+
+    name = 'cg'
+    state = ['K', 'M']
+    multiple_rhs = False
+
+    def __init__(self, options, block_size=1):
+        super(CGSolver, self).__init__(options, block_size=block_size)
+        self.report['iterations'] = []
+
+    def _factorize(self, K, symbolic):
+        self.K = sparse.csr_matrix(K)
+        preconditioner = self.options['preconditioner']
+        if (preconditioner == 'block_jacobi') & \
+                (self.K.shape[0] % self.block_size != 0):
+            logger.warning(
+                "%d columns do not divide into blocks of %d, "
+                "using jacobi preconditioner" % (
+                    self.K.shape[0], self.block_size))
+            preconditioner = 'jacobi'
+
+        self.M = None
+        if preconditioner == 'jacobi':
+            self.M = sparse.diags(1.0 / self.K.diagonal()).tocsr()
+            self.report['factor_GB'] = sparse_GB(self.M)
+        elif preconditioner == 'block_jacobi':
+            self.M = block_jacobi(self.K, self.block_size)
+            self.report['factor_GB'] = sparse_GB(self.M)
+        elif preconditioner == 'ilu':
+            # scipy has no incomplete Cholesky. Incomplete LU with a
+            # symmetric ordering and no pivoting is the nearest to it.
+            # K is scaled to unit diagonal first, the regularization
+            # spreads its diagonal over many orders of magnitude
+            d = 1.0 / np.sqrt(self.K.diagonal())
+            D = sparse.diags(d)
+            ilu = spilu(
+                sparse.csc_matrix(D.dot(self.K).dot(D)),
+                drop_tol=self.options['drop_tolerance'],
+                fill_factor=self.options['fill_factor'],
+                permc_spec='MMD_AT_PLUS_A',
+                diag_pivot_thresh=0.0)
+            self.M = LinearOperator(
+                self.K.shape, lambda r: d * ilu.solve(d * r))
+            self.report['factor_GB'] = sparse_GB(ilu.L, ilu.U)
+        return None
+
+    def _solve(self, b, x0):
+        if not self.options['warm_start']:
+            x0 = None
+        niter = [0]
+
+        def count(xk):
+            niter[0] += 1
+
+        x, info = conjugate_gradient(
+            self.K,
+            b,
+            x0=x0,
+            tol=self.options['tolerance'],
+            maxiter=self.options['max_iterations'],
+            M=self.M,
+            callback=count)
+        self.report['iterations'].append(niter[0])
+        if info < 0:
+            raise EMalignerException(
+                "conjugate gradient solve failed")
+        if info > 0:
+            logger.warning(
+                "conjugate gradient did not reach tolerance %0.1e "
+                "in %d iterations" % (self.options['tolerance'], info))
+        return x
+
+    def message(self):
+        return super(CGSolver, self).message() + \
+            ', iterations %s' % self.report['iterations']
+
+
+class ComponentSolver(Solver):
+    """K split into its connected components, each factorized and
+    solved on its own by the chosen backend, in threads when n_threads
+    is more than 1. Components of a single column, such as those of
+    tiles with no point matches, are solved by division"""
+
+    name = 'components'
+
+    def __init__(self, options, block_size=1):
+        super(ComponentSolver, self).__init__(options, block_size=block_size)
+        self.options = dict(options, split_components=False)
+        backend = make_solver(self.options)
+        self.report['backend'] = backend.name
+        if 'iterations' in backend.report:
+            self.report['iterations'] = []
+        self.report['components'] = 0
+        self.report['largest_component'] = 0
+        self.report['disconnected'] = 0
+
+    def map(self, func, items):
+        nthreads = min(self.options['n_threads'], len(items))
+        if nthreads < 2:
+            return [func(i) for i in items]
+        pool = ThreadPool(nthreads)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def factorize(self, K):
+        t0 = time.time()
+        K = sparse.csc_matrix(K)
+        ncomponents, labels = connected_components(K, directed=False)
+        sizes = np.bincount(labels, minlength=ncomponents)
+        single = sizes[labels] == 1
+        self.single = np.flatnonzero(single)
+        self.single_diagonal = K.diagonal()[self.single]
+
+        # the other columns, grouped by component, in order within each
+        cols = np.flatnonzero(~single)
+        cols = cols[np.argsort(labels[cols], kind='mergesort')]
+        self.components = np.split(
+            cols, np.flatnonzero(np.diff(labels[cols])) + 1)
+        if cols.size == 0:
+            self.components = []
+
+        def factorize_one(c):
+            solver = make_solver(self.options, block_size=self.block_size)
+            solver.factorize(K[c, :][:, c])
+            return solver
+        self.solvers = self.map(factorize_one, self.components)
+
+        reports = [s.report for s in self.solvers]
+        factor_GB = [r['factor_GB'] for r in reports]
+        if None not in factor_GB:
+            self.report['factor_GB'] = np.sum(factor_GB)
+        reused = set([r['reused'] for r in reports])
+        if len(reused) == 1:
+            self.report['reused'] = reused.pop()
+        else:
+            self.report['reused'] = 'partial'
+        self.report['components'] = len(self.components)
+        self.report['largest_component'] = max(
+            [0] + [c.size for c in self.components])
+        self.report['disconnected'] = self.single.size
+        self.report['factor_time'] = time.time() - t0
+        self.report['peak_GB'] = peak_memory_GB()
+
+    def _solve(self, b, x0):
+        x = np.zeros(b.shape)
+        d = self.single_diagonal
+        if np.ndim(b) == 2:
+            d = d.reshape(-1, 1)
+        x[self.single] = b[self.single] / d
+
+        def solve_one(i):
+            c = self.components[i]
+            return self.solvers[i].solve(
+                b[c], None if x0 is None else x0[c])
+        xs = self.map(solve_one, list(range(len(self.components))))
+        for c, xc in zip(self.components, xs):
+            x[c] = xc
+
+        if 'iterations' in self.report:
+            self.report['iterations'] = []
+            for solver in self.solvers:
+                self.report['iterations'] += solver.report['iterations']
+        return x
+
+    def message(self):
+        r = self.report
+        message = super(ComponentSolver, self).message()
+        message += ', %d components, largest %d columns, ' \
+            '%d disconnected columns' % (
+                r['components'], r['largest_component'], r['disconnected'])
+        return message
+
+
+class ReorderedSolver(Solver):
+    """K with its tiles reordered for less fill, solved by the chosen
+    backend. Solutions come back in the original order"""
+
+    name = 'reordered'
+
+    def __init__(self, options, block_size=1, tile_positions=None):
+        super(ReorderedSolver, self).__init__(options, block_size=block_size)
+        self.options = dict(options, ordering='none')
+        self.ordering = options['ordering']
+        self.tile_positions = tile_positions
+        self.solver = make_solver(self.options, block_size=block_size)
+        self.report = self.solver.report
+        self.report['ordering'] = self.ordering
+        self.report['bandwidth'] = None
+
+    def factorize(self, K):
+        t0 = time.time()
+        K = sparse.csc_matrix(K)
+        ntiles = K.shape[0] // self.block_size
+        ordering = self.ordering
+        if (ordering == 'hilbert') & (
+                (self.tile_positions is None) or
+                (len(self.tile_positions) != ntiles)):
+            logger.warning(
+                "no tile positions for hilbert ordering, using rcm")
+            ordering = 'rcm'
+        if ordering == 'hilbert':
+            tile_order = hilbert_order(self.tile_positions)
+        else:
+            tile_order = rcm_order(K, self.block_size)
+        self.perm = tile_columns(tile_order, self.block_size)
+        Kp = K[self.perm, :][:, self.perm]
+        self.report['bandwidth'] = [bandwidth(K), bandwidth(Kp)]
+        self.solver.factorize(Kp)
+        self.report['factor_time'] = time.time() - t0
+
+    def solve(self, b, x0=None):
+        # the report is shared, the inner solver times the solve
+        xp = self.solver.solve(
+            b[self.perm], None if x0 is None else x0[self.perm])
+        x = np.empty_like(xp)
+        x[self.perm] = xp
+        return x
+
+    def message(self):
+        return self.solver.message() + \
+            ', %s ordering, bandwidth %d -> %d' % (
+                self.report['ordering'],
+                self.report['bandwidth'][0],
+                self.report['bandwidth'][1])
+
+
+def uv_halves(K, block_size):
+    # for fullsize affine, the first (u) and second (v) half of each
+    # tile's columns, and K for the u half. None if a u row touches
+    # a v column, or the v half of K is not the u half shifted
+    half = block_size // 2
+    K = sparse.csr_matrix(K)
+    K.sum_duplicates()
+    first = (np.arange(K.shape[0]) % block_size) < half
+    i0 = np.flatnonzero(first)
+    i1 = np.flatnonzero(~first)
+    nrow = np.diff(K.indptr)
+    if np.any(nrow[i0] != nrow[i1]):
+        return None
+    # positions in K.data of the u rows and of the v rows
+    n0 = nrow[i0]
+    start = np.concatenate([[0], np.cumsum(n0)[:-1]])
+    offset = np.arange(n0.sum()) - np.repeat(start, n0)
+    p0 = np.repeat(K.indptr[i0], n0) + offset
+    p1 = np.repeat(K.indptr[i1], n0) + offset
+    c0 = K.indices[p0]
+    if (np.any((c0 % block_size) >= half) |
+            np.any(K.indices[p1] != c0 + half) |
+            np.any(K.data[p1] != K.data[p0])):
+        return None
+    K0 = sparse.csr_matrix(
+        (K.data[p0], (c0 // block_size) * half + c0 % block_size,
+         np.concatenate([[0], np.cumsum(n0)])),
+        shape=(i0.size, i0.size))
+    return i0, i1, K0
+
+
+def bandwidth(K):
+    # largest distance of a nonzero from the diagonal
+    Kc = K.tocoo()
+    if Kc.nnz == 0:
+        return 0
+    return int(np.abs(Kc.row - Kc.col).max())
+
+
+def tile_columns(tile_order, block_size):
+    # column order from a tile order, for contiguous tile columns
+    return (
+        block_size * np.repeat(tile_order, block_size) +
+        np.tile(np.arange(block_size), len(tile_order)))
+
+
+def rcm_order(K, block_size):
+    # reverse Cuthill-McKee on the graph of tiles connected in K
+    Kc = K.tocoo()
+    ntiles = K.shape[0] // block_size
+    tiles = sparse.csr_matrix(
+        (np.ones(Kc.nnz), (Kc.row // block_size, Kc.col // block_size)),
+        shape=(ntiles, ntiles))
+    return np.asarray(
+        reverse_cuthill_mckee(tiles, symmetric_mode=True)).astype('int64')
+
+
+def hilbert_index(x, y, order=16):
+    # distance along a Hilbert curve of integer x, y in [0, 2**order)
+    x = np.array(x, dtype='int64')
+    y = np.array(y, dtype='int64')
+    n = 2 ** order
+    d = np.zeros(x.shape, dtype='int64')
+    s = n // 2
+    while s > 0:
+        rx = ((x & s) > 0).astype('int64')
+        ry = ((y & s) > 0).astype('int64')
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = (ry == 0) & (rx == 1)
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ry == 0
+        x[swap], y[swap] = y[swap], x[swap]
+        s //= 2
+    return d
+
+
+def hilbert_order(positions, order=16):
+    # tiles along a Hilbert curve through their x, y, then by z,
+    # so tiles above each other in z stay close together
+    positions = np.asarray(positions, dtype='float64')
+    xy = positions[:, 0:2] - positions[:, 0:2].min(axis=0)
+    scale = xy.max()
+    if scale > 0:
+        xy *= (2 ** order - 1) / scale
+    d = hilbert_index(xy[:, 0], xy[:, 1], order=order)
+    return np.lexsort((positions[:, 2], d))
+
+
+def block_jacobi(K, block_size):
+    # inverse of the diagonal blocks of K, one block per tile
+    n = K.shape[0]
+    nblocks = n // block_size
+    Kc = K.tocoo()
+    inblock = (Kc.row // block_size) == (Kc.col // block_size)
+    row = Kc.row[inblock]
+    col = Kc.col[inblock]
+    blocks = np.zeros((nblocks, block_size, block_size))
+    np.add.at(
+        blocks,
+        (row // block_size, row % block_size, col % block_size),
+        Kc.data[inblock])
+    blocks = np.linalg.inv(blocks)
+    return sparse.bsr_matrix(
+        (blocks, np.arange(nblocks), np.arange(nblocks + 1)),
+        shape=(n, n)).tocsr()
+
+
+def conjugate_gradient(K, b, x0=None, tol=1e-10, maxiter=None, M=None,
+                       callback=None):
+    try:
+        return cg(
+            K, b, x0=x0, rtol=tol, atol=0.0, maxiter=maxiter, M=M,
+            callback=callback)
+    except TypeError:
+        # scipy < 1.12
+        return cg(
+            K, b, x0=x0, tol=tol, atol=0.0, maxiter=maxiter, M=M,
+            callback=callback)
+
+
+solver_backends = {
+    'lu': LUSolver,
+    'cholmod': CholmodSolver,
+    'cg': CGSolver}
+
+
+def make_solver(options, block_size=1, tile_positions=None):
+    # tile_positions, x, y, z of each tile, for hilbert ordering
+    if options['ordering'] != 'none':
+        return ReorderedSolver(
+            options, block_size=block_size, tile_positions=tile_positions)
+    if options['split_components']:
+        return ComponentSolver(options, block_size=block_size)
+    backend = options['backend']
+    if (backend == 'cholmod') & (cholesky is None):
+        logger.warning(
+            "scikit-sparse is not installed, using lu instead of cholmod")
+        backend = 'lu'
+    if backend not in solver_backends:
+        raise EMalignerException(
+            "solver backend %s not in possible choices: %s" % (
+                backend, list(solver_backends.keys())))
+    return solver_backends[backend](options, block_size=block_size)
@@ -2,6 +2,8 @@ import renderapi
 from .utils import (
         AlignerTransformException,
         ptpair_indices,
+        ptpair_indices_batch,
+        rows_for_tilepairs,
         arrays_for_tilepair)
 import numpy as np
 import scipy.sparse as sparse
@@ -105,6 +107,18 @@ class AlignerAffineModel(renderapi.transform.AffineModel):
                     match, tile_ind1, tile_ind2,
                     nmin, nmax, choose_random)
 
+    def CSR_from_tilepairs(
+            self, matches, tile_ind1, tile_ind2,
+            nmin, nmax, choose_random):
+        if self.fullsize:
+            return self.CSR_fullsize_batch(
+                    matches, tile_ind1, tile_ind2,
+                    nmin, nmax, choose_random)
+        else:
+            return self.CSR_halfsize_batch(
+                    matches, tile_ind1, tile_ind2,
+                    nmin, nmax, choose_random)
+
     def CSR_fullsize(
             self, match, tile_ind1, tile_ind2,
             nmin, nmax, choose_random):
@@ -204,3 +218,81 @@ class AlignerAffineModel(renderapi.transform.AffineModel):
         weights[0: npts] = np.array(match['matches']['w'])[match_index]
 
         return data, indices, indptr, weights, npts
+
+    def CSR_fullsize_batch(
+            self, matches, tile_ind1, tile_ind2,
+            nmin, nmax, choose_random):
+        match_index, npts = ptpair_indices_batch(
+                matches.counts, matches.w, nmin, nmax, choose_random)
+        if match_index.size == 0:
+            # no tile pair met the requirements
+            return None, None, None, None, None
+
+        # empty arrays, one row of nnz_per_row for each row in A
+        data, indices, indptr, weights = (
+                arrays_for_tilepair(
+                   match_index.size,
+                   self.rows_per_ptmatch,
+                   self.nnz_per_row))
+        data = data.reshape(-1, self.nnz_per_row)
+        indices = indices.reshape(-1, self.nnz_per_row)
+        rows = rows_for_tilepairs(npts, self.rows_per_ptmatch)
+
+        # u=ax+by+c
+        data[rows[0], 0] = matches.p[0, match_index]
+        data[rows[0], 1] = matches.p[1, match_index]
+        data[rows[0], 2] = 1.0
+        data[rows[0], 3] = -1.0 * matches.q[0, match_index]
+        data[rows[0], 4] = -1.0 * matches.q[1, match_index]
+        data[rows[0], 5] = -1.0
+        uindices = np.hstack((
+            np.repeat(tile_ind1, npts).reshape(-1, 1) *
+            self.DOF_per_tile + np.array([0, 1, 2]),
+            np.repeat(tile_ind2, npts).reshape(-1, 1) *
+            self.DOF_per_tile + np.array([0, 1, 2])))
+        indices[rows[0]] = uindices
+        # v=dx+ey+f
+        data[rows[1]] = data[rows[0]]
+        indices[rows[1]] = uindices + 3
+
+        # indptr and weights
+        indptr[:] = np.arange(1, indptr.size + 1) * self.nnz_per_row
+        weights[rows] = matches.w[match_index]
+
+        return data.ravel(), indices.ravel(), indptr, weights, npts
+
+    def CSR_halfsize_batch(
+            self, matches, tile_ind1, tile_ind2,
+            nmin, nmax, choose_random):
+        match_index, npts = ptpair_indices_batch(
+                matches.counts, matches.w, nmin, nmax, choose_random)
+        if match_index.size == 0:
+            # no tile pair met the requirements
+            return None, None, None, None, None
+
+        # empty arrays, one row of nnz_per_row for each row in A
+        data, indices, indptr, weights = (
+                arrays_for_tilepair(
+                   match_index.size,
+                   self.rows_per_ptmatch,
+                   self.nnz_per_row))
+        data = data.reshape(-1, self.nnz_per_row)
+        indices = indices.reshape(-1, self.nnz_per_row)
+        rows = rows_for_tilepairs(npts, self.rows_per_ptmatch)
+
+        # u=ax+by+c
+        data[rows[0], 0] = matches.p[0, match_index]
+        data[rows[0], 1] = matches.p[1, match_index]
+        data[rows[0], 2] = 1.0
+        data[rows[0], 3] = -1.0 * matches.q[0, match_index]
+        data[rows[0], 4] = -1.0 * matches.q[1, match_index]
+        data[rows[0], 5] = -1.0
+        indices[rows[0]] = np.hstack((
+            np.repeat(tile_ind1, npts).reshape(-1, 1) *
+            self.DOF_per_tile / 2 + np.array([0, 1, 2]),
+            np.repeat(tile_ind2, npts).reshape(-1, 1) *
+            self.DOF_per_tile / 2 + np.array([0, 1, 2])))
+        indptr[:] = np.arange(1, indptr.size + 1) * self.nnz_per_row
+        weights[rows] = matches.w[match_index]
+
+        return data.ravel(), indices.ravel(), indptr, weights, npts
@@ -2,6 +2,8 @@ import renderapi
 from .utils import (
         AlignerTransformException,
         ptpair_indices,
+        ptpair_indices_batch,
+        rows_for_tilepairs,
         arrays_for_tilepair)
 import numpy as np
 import scipy.sparse as sparse
@@ -142,3 +144,46 @@ class AlignerPolynomial2DTransform(renderapi.transform.Polynomial2DTransform):
         weights[0: npts] = np.array(match['matches']['w'])[match_index]
 
         return data, indices, indptr, weights, npts
+
+    def CSR_from_tilepairs(
+            self, matches, tile_ind1, tile_ind2,
+            nmin, nmax, choose_random):
+        match_index, npts = ptpair_indices_batch(
+                matches.counts, matches.w, nmin, nmax, choose_random)
+        if match_index.size == 0:
+            # no tile pair met the requirements
+            return None, None, None, None, None
+
+        # empty arrays, one row of nnz_per_row for each row in A
+        data, indices, indptr, weights = (
+                arrays_for_tilepair(
+                   match_index.size,
+                   self.rows_per_ptmatch,
+                   self.nnz_per_row))
+        data = data.reshape(-1, self.nnz_per_row)
+        indices = indices.reshape(-1, self.nnz_per_row)
+        rows = rows_for_tilepairs(npts, self.rows_per_ptmatch)
+
+        px = matches.p[0, match_index]
+        py = matches.p[1, match_index]
+        qx = matches.q[0, match_index]
+        qy = matches.q[1, match_index]
+
+        k = 0
+        qoff = int(self.nnz_per_row / 2)
+        for j in range(self.order + 1):
+            for i in range(j + 1):
+                data[rows[0], k] = px ** (j - i) * py ** i
+                data[rows[0], k + qoff] = -qx ** (j - i) * qy ** i
+                k += 1
+
+        ir = np.arange(int(self.nnz_per_row / 2))
+        indices[rows[0]] = np.hstack((
+            np.repeat(tile_ind1, npts).reshape(-1, 1) *
+            self.DOF_per_tile / 2 + ir,
+            np.repeat(tile_ind2, npts).reshape(-1, 1) *
+            self.DOF_per_tile / 2 + ir))
+        indptr[:] = np.arange(1, indptr.size + 1) * self.nnz_per_row
+        weights[rows] = matches.w[match_index]
+
+        return data.ravel(), indices.ravel(), indptr, weights, npts
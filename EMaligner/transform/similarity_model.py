@@ -2,6 +2,8 @@ import renderapi
 from .utils import (
         AlignerTransformException,
         ptpair_indices,
+        ptpair_indices_batch,
+        rows_for_tilepairs,
         arrays_for_tilepair)
 import numpy as np
 import scipy.sparse as sparse
@@ -165,3 +167,82 @@ class AlignerSimilarityModel(renderapi.transform.AffineModel):
                 self.rows_per_ptmatch)
 
         return data, indices, indptr, weights, npts
+
+    def CSR_from_tilepairs(
+            self, matches, tile_ind1, tile_ind2,
+            nmin, nmax, choose_random):
+        match_index, npts = ptpair_indices_batch(
+                matches.counts, matches.w, nmin, nmax, choose_random)
+        if match_index.size == 0:
+            # no tile pair met the requirements
+            return None, None, None, None, None
+
+        # empty arrays, one row of nnz_per_row for each row in A
+        data, indices, indptr, weights = (
+                arrays_for_tilepair(
+                   match_index.size,
+                   self.rows_per_ptmatch,
+                   self.nnz_per_row))
+        data = data.reshape(-1, self.nnz_per_row)
+        indices = indices.reshape(-1, self.nnz_per_row)
+        rows = rows_for_tilepairs(npts, self.rows_per_ptmatch)
+
+        px = matches.p[0, match_index]
+        py = matches.p[1, match_index]
+        qx = matches.q[0, match_index]
+        qy = matches.q[1, match_index]
+
+        # per tile pair means
+        # np.add.reduceat() does not sum the same way as ndarray.mean()
+        used = npts[npts != 0]
+        splits = np.cumsum(used)[:-1]
+        pxm, pym, qxm, qym = [
+                np.repeat([s.mean() for s in np.split(x, splits)], used)
+                for x in [px, py, qx, qy]]
+
+        t1 = np.repeat(tile_ind1, npts).reshape(-1, 1) * self.DOF_per_tile
+        t2 = np.repeat(tile_ind2, npts).reshape(-1, 1) * self.DOF_per_tile
+        uindices = np.hstack((
+            t1 + np.array([0, 1, 2]),
+            t2 + np.array([0, 1, 2])))
+        vindices = np.hstack((
+            t1 + np.array([1, 0, 3]),
+            t2 + np.array([1, 0, 3])))
+
+        # u=ax+by+c
+        data[rows[0], 0] = px
+        data[rows[0], 1] = py
+        data[rows[0], 2] = 1.0
+        data[rows[0], 3] = -1.0 * qx
+        data[rows[0], 4] = -1.0 * qy
+        data[rows[0], 5] = -1.0
+        indices[rows[0]] = uindices
+        # v=-bx+ay+d
+        data[rows[1], 0] = -1.0 * px
+        data[rows[1], 1] = py
+        data[rows[1], 2] = 1.0
+        data[rows[1], 3] = 1.0 * qx
+        data[rows[1], 4] = -1.0 * qy
+        data[rows[1], 5] = -1.0
+        indices[rows[1]] = vindices
+        # du
+        data[rows[2], 0] = px - pxm
+        data[rows[2], 1] = py - pym
+        data[rows[2], 2] = 0.0
+        data[rows[2], 3] = -1.0 * (qx - qxm)
+        data[rows[2], 4] = -1.0 * (qy - qym)
+        data[rows[2], 5] = -0.0
+        indices[rows[2]] = uindices
+        # dv
+        data[rows[3], 0] = -1.0 * (px - pxm)
+        data[rows[3], 1] = py - pym
+        data[rows[3], 2] = 0.0
+        data[rows[3], 3] = 1.0 * (qx - qxm)
+        data[rows[3], 4] = -1.0 * (qy - qym)
+        data[rows[3], 5] = -0.0
+        indices[rows[3]] = uindices
+
+        indptr[:] = np.arange(1, indptr.size + 1) * self.nnz_per_row
+        weights[rows] = matches.w[match_index]
+
+        return data.ravel(), indices.ravel(), indptr, weights, npts
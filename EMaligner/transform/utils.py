@@ -38,3 +38,168 @@ def arrays_for_tilepair(npts, rows_per_ptmatch, nnz_per_row):
     indptr = np.zeros(ni)
     weights = np.zeros(ni)
     return data, indices, indptr, weights
+
+
+class MatchArrays(object):
+    """point matches for many tile pairs, held in contiguous arrays
+
+    pId, qId, pGroupId, qGroupId : ids for each tile pair
+    offsets : points for tile pair k are offsets[k]:offsets[k + 1]
+    p, q : (2, N) float64 point coordinates
+    w : (N,) float64 point weights
+    """
+
+    def __init__(
+            self, pId=None, qId=None, pGroupId=None, qGroupId=None,
+            offsets=None, p=None, q=None, w=None):
+        self.pId = np.array([] if pId is None else pId).astype('U')
+        self.qId = np.array([] if qId is None else qId).astype('U')
+        self.pGroupId = np.array(
+                [] if pGroupId is None else pGroupId).astype('U')
+        self.qGroupId = np.array(
+                [] if qGroupId is None else qGroupId).astype('U')
+        self.offsets = np.array(
+                [0] if offsets is None else offsets).astype('int64')
+        self.p = np.zeros((2, 0)) if p is None else p
+        self.q = np.zeros((2, 0)) if q is None else q
+        self.w = np.zeros(0) if w is None else w
+
+    def __len__(self):
+        return self.pId.size
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @classmethod
+    def from_dicts(cls, matches):
+        # matches can be a list, a mongo cursor or any other iterable
+        # of render point match dicts, they are consumed one at a time
+        ids = []
+        p = []
+        q = []
+        w = []
+        for m in matches:
+            ids.append((
+                m['pId'],
+                m['qId'],
+                m.get('pGroupId', ''),
+                m.get('qGroupId', '')))
+            p.append(np.asarray(m['matches']['p'], dtype='float64'))
+            q.append(np.asarray(m['matches']['q'], dtype='float64'))
+            w.append(np.asarray(m['matches']['w'], dtype='float64'))
+
+        if len(ids) == 0:
+            return cls()
+
+        ids = np.array(ids).astype('U').reshape(-1, 4)
+        counts = [x.size for x in w]
+        return cls(
+                pId=ids[:, 0],
+                qId=ids[:, 1],
+                pGroupId=ids[:, 2],
+                qGroupId=ids[:, 3],
+                offsets=np.insert(np.cumsum(counts), 0, 0),
+                p=np.concatenate(
+                    [x.reshape(2, -1) for x in p], axis=1),
+                q=np.concatenate(
+                    [x.reshape(2, -1) for x in q], axis=1),
+                w=np.concatenate(w))
+
+    @classmethod
+    def concatenate(cls, arrays):
+        arrays = [a for a in arrays if len(a) != 0]
+        if len(arrays) == 0:
+            return cls()
+        offsets = [np.zeros(1).astype('int64')]
+        for a in arrays:
+            offsets.append(a.offsets[1:] + offsets[-1][-1])
+        return cls(
+                pId=np.concatenate([a.pId for a in arrays]),
+                qId=np.concatenate([a.qId for a in arrays]),
+                pGroupId=np.concatenate([a.pGroupId for a in arrays]),
+                qGroupId=np.concatenate([a.qGroupId for a in arrays]),
+                offsets=np.concatenate(offsets),
+                p=np.concatenate([a.p for a in arrays], axis=1),
+                q=np.concatenate([a.q for a in arrays], axis=1),
+                w=np.concatenate([a.w for a in arrays]))
+
+    def select(self, ind):
+        # a new MatchArrays with a subset of the tile pairs
+        # ind is a boolean mask or integer indices of tile pairs
+        ind = np.arange(len(self))[ind]
+        counts = self.counts[ind]
+        starts = np.cumsum(counts) - counts
+        pts = np.arange(counts.sum()) + \
+            np.repeat(self.offsets[ind] - starts, counts)
+        return MatchArrays(
+                pId=self.pId[ind],
+                qId=self.qId[ind],
+                pGroupId=self.pGroupId[ind],
+                qGroupId=self.qGroupId[ind],
+                offsets=np.insert(np.cumsum(counts), 0, 0),
+                p=self.p[:, pts],
+                q=self.q[:, pts],
+                w=self.w[pts])
+
+    def to_dicts(self):
+        # back to render point match dicts
+        matches = []
+        for k in range(len(self)):
+            i0, i1 = self.offsets[k: k + 2]
+            matches.append({
+                'pId': self.pId[k],
+                'qId': self.qId[k],
+                'pGroupId': self.pGroupId[k],
+                'qGroupId': self.qGroupId[k],
+                'matches': {
+                    'p': self.p[:, i0:i1].tolist(),
+                    'q': self.q[:, i0:i1].tolist(),
+                    'w': self.w[i0:i1].tolist()}})
+        return matches
+
+
+def ptpair_indices_batch(counts, w, nmin, nmax, choose_random):
+    # ptpair_indices() for many tile pairs at once
+    # counts are the number of points in each tile pair, and the
+    # points of all tile pairs are concatenated in w
+    npairs = counts.size
+    offsets = np.cumsum(counts) - counts
+
+    # pairs where all weights are zero are skipped
+    pair_of_pt = np.repeat(np.arange(npairs), counts)
+    nonzero = np.bincount(
+            pair_of_pt,
+            weights=(w != 0),
+            minlength=npairs) > 0
+    keep = nonzero & (counts >= nmin)
+
+    npts = np.zeros(npairs).astype('int64')
+    npts[keep] = np.minimum(counts[keep], nmax)
+
+    if choose_random:
+        # loop, to consume the random state in the same order
+        # as the per-tilepair path
+        match_index = [np.zeros(0).astype('int64')]
+        for k in np.argwhere(keep).flatten():
+            m, s = ptpair_indices(counts[k], nmin, nmax, 1, True)
+            match_index.append(m + offsets[k])
+        match_index = np.concatenate(match_index)
+    else:
+        starts = np.cumsum(npts) - npts
+        match_index = \
+            np.arange(npts.sum()) + np.repeat(offsets - starts, npts)
+
+    return match_index, npts
+
+
+def rows_for_tilepairs(npts, rows_per_ptmatch):
+    # row locations for a batch of tile pairs
+    # row blocks within a tile pair are ordered as in CSR_from_tilepair()
+    # returns an array shaped (rows_per_ptmatch, npts.sum())
+    starts = np.cumsum(npts) - npts
+    local = np.arange(npts.sum()) - np.repeat(starts, npts)
+    first = np.repeat(starts * rows_per_ptmatch, npts) + local
+    blocks = np.arange(rows_per_ptmatch).reshape(-1, 1) * \
+        np.repeat(npts, npts)
+    return first + blocks
@@ -2,17 +2,27 @@ from pymongo import MongoClient
 import numpy as np
 import renderapi
 from renderapi.external.processpools import pool_pathos
+from multiprocessing.pool import ThreadPool
 import collections
+import itertools
 import logging
+import requests
+import threading
 import time
 import warnings
 import os
 import sys
 import json
 from .transform.transform import AlignerTransform
+from .transform.utils import MatchArrays
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 import h5py
+try:
+    # registers the blosc filter with h5py, for writing and reading
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
 logger2 = logging.getLogger(__name__)
 
@@ -80,8 +90,86 @@ def get_unused_tspecs(stack, tids):
     return np.array(tspecs)
 
 
-def get_tileids_and_tforms(stack, tform_name, zvals, fullsize=False, order=2):
+def get_z_tilespecs(
+        stack, z, dbconnection, transform_dbconnection=None, session=None):
+    # tile specs, shared transforms and sectionId for one z
+    # sectionId is None if the section is missing
+    # session is an optional requests.Session to reuse for render
+    tspecs = []
+    shared_tforms = []
+    sectionId = None
+
+    # load tile specs from the database
+    if stack['db_interface'] == 'render':
+        try:
+            tmp = renderapi.resolvedtiles.get_resolved_tiles_from_z(
+                    stack['name'][0],
+                    float(z),
+                    render=dbconnection,
+                    owner=stack['owner'],
+                    project=stack['project'],
+                    session=session)
+            tspecs = tmp.tilespecs
+            for st in tmp.transforms:
+                shared_tforms.append(st)
+            try:
+                sectionId = renderapi.stack.get_sectionId_for_z(
+                    stack['name'][0],
+                    float(z),
+                    render=dbconnection,
+                    owner=stack['owner'],
+                    project=stack['project'],
+                    session=session)
+            except renderapi.errors.RenderError:
+                sectionId = collections.Counter([
+                    ts.layout.sectionId for ts in tspecs]
+                    ).most_common()[0][0]
+        except renderapi.errors.RenderError:
+            # missing section
+            sectionId = None
+            pass
+
+    if stack['db_interface'] == 'mongo':
+        filt = {'z': float(z)}
+        if dbconnection.count_documents(filt) == 0:
+            sectionId = None
+        else:
+            cursor = dbconnection.find(filt).sort([
+                    ('layout.imageRow', 1),
+                    ('layout.imageCol', 1)])
+            tspecs = list(cursor)
+            refids = []
+            for ts in tspecs:
+                for m in np.arange(len(ts['transforms']['specList'])):
+                    if 'refId' in ts['transforms']['specList'][m]:
+                        refids.append(
+                                ts['transforms']['specList'][m]['refId'])
+            refids = np.unique(np.array(refids))
+            # be selective of which transforms to pass on to the new stack
+            if transform_dbconnection is None:
+                transform_dbconnection = make_dbconnection(
+                        stack, which='transform')
+            for refid in refids:
+                shared_tforms.append(
+                        renderapi.transform.load_transform_json(
+                            list(transform_dbconnection.find(
+                                {"id": refid}))[0]))
+            sectionId = dbconnection.find(
+                    {"z": float(z)}).distinct("layout.sectionId")[0]
+            tspecs = [renderapi.tilespec.TileSpec(json=ts) for ts in tspecs]
+
+    return tspecs, shared_tforms, sectionId
+
+
+def get_tileids_and_tforms(
+        stack, tform_name, zvals, fullsize=False, order=2, cache=None,
+        nthreads=1):
+    # cache is an optional cache.TileSpecCache
+    # nthreads > 1 loads that many z values concurrently
     dbconnection = make_dbconnection(stack)
+    transform_dbconnection = None
+    if stack['db_interface'] == 'mongo':
+        transform_dbconnection = make_dbconnection(stack, which='transform')
 
     tile_ids = []
     tile_tforms = []
@@ -91,70 +179,41 @@ def get_tileids_and_tforms(stack, tform_name, zvals, fullsize=False, order=2):
     z_present = []
     t0 = time.time()
 
-    for z in zvals:
-        # load tile specs from the database
-        if stack['db_interface'] == 'render':
-            try:
-                tmp = renderapi.resolvedtiles.get_resolved_tiles_from_z(
-                        stack['name'][0],
-                        float(z),
-                        render=dbconnection,
-                        owner=stack['owner'],
-                        project=stack['project'])
-                tspecs = tmp.tilespecs
-                for st in tmp.transforms:
-                    shared_tforms.append(st)
-                try:
-                    sectionId = renderapi.stack.get_sectionId_for_z(
-                        stack['name'][0],
-                        float(z),
-                        render=dbconnection,
-                        owner=stack['owner'],
-                        project=stack['project'])
-                except renderapi.errors.RenderError:
-                    sectionId = collections.Counter([
-                        ts.layout.sectionId for ts in tspecs]
-                        ).most_common()[0][0]
-            except renderapi.errors.RenderError:
-                # missing section
-                sectionId = None
-                pass
-
-        if stack['db_interface'] == 'mongo':
-            filt = {'z': float(z)}
-            if dbconnection.count_documents(filt) == 0:
-                sectionId = None
-            else:
-                cursor = dbconnection.find(filt).sort([
-                        ('layout.imageRow', 1),
-                        ('layout.imageCol', 1)])
-                tspecs = list(cursor)
-                refids = []
-                for ts in tspecs:
-                    for m in np.arange(len(ts['transforms']['specList'])):
-                        if 'refId' in ts['transforms']['specList'][m]:
-                            refids.append(
-                                    ts['transforms']['specList'][m]['refId'])
-                refids = np.unique(np.array(refids))
-                # be selective of which transforms to pass on to the new stack
-                dbconnection2 = make_dbconnection(stack, which='transform')
-                for refid in refids:
-                    shared_tforms.append(
-                            renderapi.transform.load_transform_json(
-                                list(dbconnection2.find({"id": refid}))[0]))
-                sectionId = dbconnection.find(
-                        {"z": float(z)}).distinct("layout.sectionId")[0]
+    # MongoClient is thread-safe and pools its own connections
+    # for render, each thread keeps one requests.Session
+    local = threading.local()
+
+    def load_z(z):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        if cache is not None:
+            return cache.get_tilespecs(
+                    stack, z, dbconnection, transform_dbconnection,
+                    session=local.session)
+        return get_z_tilespecs(
+                stack, z, dbconnection, transform_dbconnection,
+                session=local.session)
+
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        # map() keeps z order
+        loaded = pool.map(load_z, zvals)
+        pool.close()
+        pool.join()
+    else:
+        loaded = [load_z(z) for z in zvals]
+
+    solve_tf = AlignerTransform(
+            name=tform_name, fullsize=fullsize, order=order)
 
+    for z, (tspecs, z_tforms, sectionId) in zip(zvals, loaded):
         if sectionId is not None:
+            shared_tforms += z_tforms
             sectionIds.append(sectionId)
             z_present.append(z)
 
             # make lists of IDs and transforms
-            solve_tf = AlignerTransform(
-                    name=tform_name, fullsize=fullsize, order=order)
             for k in np.arange(len(tspecs)):
-                if stack['db_interface'] == 'mongo':
-                    tspecs[k] = renderapi.tilespec.TileSpec(json=tspecs[k])
                 tile_ids.append(tspecs[k].tileId)
                 tile_tspecs.append(tspecs[k])
                 # make space in the solve vector
@@ -162,6 +221,7 @@ def get_tileids_and_tforms(stack, tform_name, zvals, fullsize=False, order=2):
                 # with input transform as values (constraints)
                 tile_tforms.append(
                         solve_tf.to_solve_vec(tspecs[k].tforms[-1]))
+    del loaded
 
     logger2.info(
             "\n loaded %d tile specs from %d zvalues in "
@@ -184,19 +244,40 @@ def get_tileids_and_tforms(stack, tform_name, zvals, fullsize=False, order=2):
             }
 
 
-def get_matches(iId, jId, collection, dbconnection):
-    matches = []
+# fields needed to assemble A from mongo point match documents
+match_projection = {
+        '_id': False,
+        'pGroupId': True,
+        'qGroupId': True,
+        'pId': True,
+        'qId': True,
+        'matches': True}
+
+
+def get_matches(
+        iId, jId, collection, dbconnection, as_arrays=False, cache=None):
+    # as_arrays=True returns a MatchArrays object
+    # otherwise, a list of point match dicts
+    # cache is an optional cache.MatchCache
+    if cache is not None:
+        matches = cache.get_matches(iId, jId, collection, dbconnection)
+        if as_arrays:
+            return matches
+        return matches.to_dicts()
+
+    responses = []
     if collection['db_interface'] == 'render':
         if iId == jId:
             for name in collection['name']:
-                matches.extend(renderapi.pointmatch.get_matches_within_group(
-                        name,
-                        iId,
-                        owner=collection['owner'],
-                        render=dbconnection))
+                responses.append(
+                        renderapi.pointmatch.get_matches_within_group(
+                            name,
+                            iId,
+                            owner=collection['owner'],
+                            render=dbconnection))
         else:
             for name in collection['name']:
-                matches.extend(
+                responses.append(
                         renderapi.pointmatch.get_matches_from_group_to_group(
                             name,
                             iId,
@@ -204,19 +285,27 @@ def get_matches(iId, jId, collection, dbconnection):
                             owner=collection['owner'],
                             render=dbconnection))
     if collection['db_interface'] == 'mongo':
+        projection = {'_id': False}
+        if as_arrays:
+            projection = match_projection
         for dbconn in dbconnection:
-            cursor = dbconn.find(
+            responses.append(dbconn.find(
                     {'pGroupId': iId, 'qGroupId': jId},
-                    {'_id': False})
-            matches.extend(list(cursor))
+                    projection))
             if iId != jId:
                 # in principle, this does nothing if zi < zj, but, just in case
-                cursor = dbconn.find(
+                responses.append(dbconn.find(
                         {
                             'pGroupId': jId,
                             'qGroupId': iId},
-                        {'_id': False})
-                matches.extend(list(cursor))
+                        projection))
+
+    # cursors are consumed one document at a time
+    if as_arrays:
+        matches = MatchArrays.from_dicts(itertools.chain(*responses))
+    else:
+        matches = list(itertools.chain(*responses))
+
     message = ("\n %d matches for section1=%s section2=%s "
                "in pointmatch collection" % (len(matches), iId, jId))
     if len(matches) == 0:
@@ -226,33 +315,151 @@ def get_matches(iId, jId, collection, dbconnection):
     return matches
 
 
-def write_chunk_to_file(fname, c, file_weights):
+def get_matches_for_pairs(pairs, collection, dbconnection, cache=None):
+    # point matches for many (section1, section2) groupId pairs
+    # returns a list of MatchArrays, in the order of pairs
+    # with mongo, one query per collection covers all of the pairs
+    # cache is an optional cache.MatchCache
+    if cache is not None:
+        return cache.get_matches_for_pairs(pairs, collection, dbconnection)
+
+    if len(pairs) == 0:
+        return []
+
+    if collection['db_interface'] != 'mongo':
+        return [
+                get_matches(iId, jId, collection, dbconnection, as_arrays=True)
+                for iId, jId in pairs]
+
+    # route each document back to its pair and direction
+    route = collections.defaultdict(list)
+    clauses = []
+    for k, (iId, jId) in enumerate(pairs):
+        route[(iId, jId)].append((k, 0))
+        clauses.append({'pGroupId': iId, 'qGroupId': jId})
+        if iId != jId:
+            route[(jId, iId)].append((k, 1))
+            clauses.append({'pGroupId': jId, 'qGroupId': iId})
+
+    # same order as get_matches(): by collection, then direction
+    ndir = 2 * len(dbconnection)
+    buckets = [[[] for i in range(ndir)] for k in range(len(pairs))]
+    for c, dbconn in enumerate(dbconnection):
+        cursor = dbconn.find({'$or': clauses}, match_projection)
+        for m in cursor:
+            for k, direction in route[(m['pGroupId'], m['qGroupId'])]:
+                buckets[k][2 * c + direction].append(m)
+
+    matches = []
+    for (iId, jId), bucket in zip(pairs, buckets):
+        matches.append(MatchArrays.from_dicts(itertools.chain(*bucket)))
+        logger2.debug(
+                "\n %d matches for section1=%s section2=%s "
+                "in pointmatch collection" % (len(matches[-1]), iId, jId))
+    return matches
+
+
+def narrowest_int(maxval):
+    # smallest signed integer type that holds 0 to maxval
+    for dtype in ['int8', 'int16', 'int32']:
+        if maxval <= np.iinfo(dtype).max:
+            return dtype
+    return 'int64'
+
+
+def compression_filter(hdf5_options):
+    # h5py create_dataset keywords for the compression filter
+    compression = hdf5_options['compression']
+    if compression == 'none':
+        return {}
+    if (compression == 'blosc') & (hdf5plugin is None):
+        logger2.warning(
+            "hdf5plugin is not installed, using gzip instead of blosc")
+        compression = 'gzip'
+    if compression == 'blosc':
+        return dict(hdf5plugin.Blosc(
+            cname='lz4',
+            clevel=hdf5_options['compression_level'],
+            shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if compression == 'gzip':
+        return {
+            'compression': 'gzip',
+            'compression_opts': hdf5_options['compression_level'],
+            'shuffle': True}
+    return {'compression': 'lzf', 'shuffle': True}
+
+
+def write_dataset(f, name, array, shape, dtype, hdf5_options):
+    # contiguous, or chunked and compressed
+    kwargs = {}
+    if hdf5_options is not None:
+        kwargs = compression_filter(hdf5_options)
+    if kwargs:
+        kwargs['chunks'] = (
+            max(1, min(shape[0], hdf5_options['chunk_size'])),) + \
+            shape[1:]
+    dset = f.create_dataset(name, shape, dtype=dtype, **kwargs)
+    dset[:] = array.reshape(shape)
+    return dset
+
+
+def write_chunk_to_file(
+        fname, c, file_weights, hdf5_options=None, signature=None,
+        tiles_used=None):
+    # hdf5_options sets compression and index types, None writes
+    # uncompressed int64 indices
+    # signature and tiles_used are kept for incremental assembly
+    index_dtype = 'int64'
+    indptr_dtype = 'int64'
+    if (hdf5_options is not None) and hdf5_options['narrow_indices']:
+        index_dtype = narrowest_int(c.indices.max())
+        indptr_dtype = narrowest_int(c.indptr[-1])
+
     fcsr = h5py.File(fname, "w")
 
-    indptr_dset = fcsr.create_dataset(
+    write_dataset(
+            fcsr,
             "indptr",
+            c.indptr,
             (c.indptr.size, 1),
-            dtype='int64')
-    indptr_dset[:] = (c.indptr).reshape(c.indptr.size, 1)
+            indptr_dtype,
+            hdf5_options)
 
-    indices_dset = fcsr.create_dataset(
+    write_dataset(
+            fcsr,
             "indices",
+            c.indices,
             (c.indices.size, 1),
-            dtype='int64')
-    indices_dset[:] = c.indices.reshape(c.indices.size, 1)
-    nrows = indptr_dset.size-1
+            index_dtype,
+            hdf5_options)
+    nrows = c.indptr.size - 1
 
-    data_dset = fcsr.create_dataset(
+    write_dataset(
+            fcsr,
             "data",
+            c.data,
             (c.data.size,),
-            dtype='float64')
-    data_dset[:] = c.data
+            'float64',
+            hdf5_options)
 
-    weights_dset = fcsr.create_dataset(
+    write_dataset(
+            fcsr,
             "weights",
+            file_weights,
             (file_weights.size,),
-            dtype='float64')
-    weights_dset[:] = file_weights
+            'float64',
+            hdf5_options)
+
+    if signature is not None:
+        fcsr.attrs['signature'] = signature
+        fcsr.attrs['mincol'] = c.indices.min()
+        fcsr.attrs['maxcol'] = c.indices.max()
+        tiles_used = np.unique(tiles_used)
+        dset = fcsr.create_dataset(
+                "used_tile_ids",
+                (tiles_used.size,),
+                dtype=h5py.special_dtype(vlen=str))
+        dset[:] = tiles_used
     fcsr.close()
 
     logger2.info(
@@ -268,13 +475,107 @@ def write_chunk_to_file(fname, c, file_weights):
             }
 
 
+def read_chunk_signatures(fdir):
+    # metadata and used tile ids of the matrix files in fdir
+    # written with a signature, keyed by signature
+    reusable = {}
+    if not os.path.isdir(fdir):
+        return reusable
+    for name in sorted(os.listdir(fdir)):
+        if (not name.endswith('.h5')) | (name == 'solution_input.h5'):
+            continue
+        try:
+            with h5py.File(os.path.join(fdir, name), 'r') as f:
+                if 'signature' not in f.attrs:
+                    continue
+                metadata = {
+                        "name": name,
+                        "nnz": f['data'].shape[0],
+                        "mincol": int(f.attrs['mincol']),
+                        "maxcol": int(f.attrs['maxcol']),
+                        "nrows": f['indptr'].shape[0] - 1}
+                tiles_used = np.array(
+                        f['used_tile_ids'][()]).astype('U').tolist()
+                reusable[str(f.attrs['signature'])] = {
+                        'metadata': metadata,
+                        'tiles_used': tiles_used}
+        except (IOError, OSError, KeyError):
+            # partially written by an interrupted run
+            continue
+    return reusable
+
+
+def read_dataset(dset, out, start=0):
+    # out.size values of a (n,) or (n, 1) dataset, from row start,
+    # copied from a memory map when it is contiguous and uncompressed
+    n = out.size
+    if n == 0:
+        return
+    offset = dset.id.get_offset()
+    if (dset.chunks is None) and (offset is not None):
+        m = np.memmap(
+            dset.file.filename,
+            dtype=dset.dtype,
+            mode='r',
+            offset=offset,
+            shape=(int(np.prod(dset.shape)),))
+        out[:] = m[start:(start + n)]
+        del m
+    else:
+        dset.read_direct(
+            out.reshape((n,) + dset.shape[1:]),
+            source_sel=np.s_[start:(start + n)])
+
+
+def read_chunk_files(fdir, names, nnz, nrows, nthreads=1):
+    # the CSR arrays of several chunk files, stacked. Sizes from the
+    # metadata preallocate the arrays, each file is read into its slice
+    data = np.zeros(nnz.sum(), dtype='float64')
+    indices = np.zeros(nnz.sum(), dtype='int64')
+    indptr = np.zeros(nrows.sum() + 1, dtype='int64')
+    weights = np.zeros(nrows.sum(), dtype='float64')
+    nnz_start = np.concatenate(([0], np.cumsum(nnz)))
+    row_start = np.concatenate(([0], np.cumsum(nrows)))
+
+    def read_file(i):
+        fname = os.path.join(fdir, names[i])
+        k0, k1 = nnz_start[i], nnz_start[i + 1]
+        r0, r1 = row_start[i], row_start[i + 1]
+        with h5py.File(fname, 'r') as f:
+            if (f['data'].shape[0] != nnz[i]) | \
+                    (f['weights'].shape[0] != nrows[i]):
+                raise EMalignerException(
+                    "%s does not match its datafile_nnz "
+                    "and datafile_nrows" % fname)
+            read_dataset(f['data'], data[k0:k1])
+            read_dataset(f['indices'], indices[k0:k1])
+            read_dataset(f['weights'], weights[r0:r1])
+            # the first indptr of each file is 0, already in place
+            read_dataset(f['indptr'], indptr[(r0 + 1):(r1 + 1)], start=1)
+        indptr[(r0 + 1):(r1 + 1)] += k0
+        logger2.info('  %s read' % names[i])
+
+    if (nthreads > 1) & (len(names) > 1):
+        pool = ThreadPool(min(nthreads, len(names)))
+        pool.map(read_file, range(len(names)))
+        pool.close()
+        pool.join()
+    else:
+        for i in range(len(names)):
+            read_file(i)
+    return data, indices, indptr, weights
+
+
 def write_reg_and_tforms(
         args,
         metadata,
         tforms,
         reg,
         tids,
-        unused_tids):
+        unused_tids,
+        column_tids=None):
+    # column_tids, the tile of each column block in the matrix files,
+    # when they include columns for unused tiles
 
     fname = os.path.join(
             args['hdf5_options']['output_dir'],
@@ -319,6 +620,13 @@ def write_reg_and_tforms(
                 dtype=str_type)
         dset[:] = unused_tids
 
+        if column_tids is not None:
+            dset = f.create_dataset(
+                    "column_tile_ids",
+                    (column_tids.size,),
+                    dtype=str_type)
+            dset[:] = column_tids
+
         # keep track of input args
         dset = f.create_dataset(
                 "input_args",
@@ -0,0 +1,591 @@
+import numpy as np
+import scipy.sparse as sparse
+import copy
+import os
+import time
+import threading
+import h5py
+import pytest
+from marshmallow import ValidationError
+from multiprocessing.pool import ThreadPool
+from test_data import montage_parameters
+from test_cache import FakeMongoCollection, example_match
+from EMaligner import EMaligner, solvers, utils
+
+
+def random_chunk(nrows, ncols, z):
+    c = sparse.random(nrows, ncols, density=0.2, format='csr')
+    return {
+        'data': c.data,
+        'indices': c.indices.astype('int64'),
+        'indptr': c.indptr.astype('int64'),
+        'weights': np.random.rand(nrows),
+        'nnz': c.nnz,
+        'nrows': nrows,
+        'zlist': np.array([z, z + 1]),
+        'tiles_used': []}
+
+
+def empty_chunk():
+    return {
+        'data': None,
+        'indices': None,
+        'indptr': None,
+        'weights': None,
+        'nnz': 0,
+        'nrows': 0,
+        'zlist': [],
+        'tiles_used': []}
+
+
+def test_tile_index():
+    tile_ids = np.array(['t%d' % i for i in np.random.permutation(100)])
+    tile_index = EMaligner.TileIndex(tile_ids)
+    ids = np.array(['t5', 't99', 'x', 't0', 'a', 'zz'])
+    cols, found = tile_index.lookup(ids)
+    assert np.all(found == [True, True, False, True, False, False])
+    assert np.all(tile_ids[cols[found]] == ids[found])
+
+
+def test_shared_chunks(tmpdir):
+    mod = EMaligner.EMaligner(
+            input_data=copy.deepcopy(montage_parameters), args=[])
+    chunks = [random_chunk(np.random.randint(1, 20), 50, z) for z in range(5)]
+    chunks.insert(2, empty_chunk())
+    expected = sparse.vstack([
+        sparse.csr_matrix((c['data'], c['indices'], c['indptr']), shape=(
+            c['nrows'], 50))
+        for c in chunks if c['data'] is not None]).tocsr()
+
+    # returned through the pool, or through scratch files
+    shared = [
+            EMaligner.share_chunk(copy.deepcopy(c), str(tmpdir))
+            for c in chunks]
+    assert isinstance(shared[0]['data'], str)
+    assert len(os.listdir(str(tmpdir))) == 20
+    for c in [chunks, shared]:
+        cat = mod.concatenate_chunks(c)
+        A = sparse.csr_matrix(
+                (cat['data'], cat['indices'], cat['indptr']),
+                shape=expected.shape)
+        assert (A != expected).nnz == 0
+        assert np.all(cat['weights'] == np.concatenate(
+            [c['weights'] for c in chunks if c['data'] is not None]))
+        assert np.all(cat['zlist'] == np.concatenate(
+            [c['zlist'] for c in chunks if c['data'] is not None]))
+        assert cat['indices'].dtype == cat['indptr'].dtype == 'int64'
+
+    cat = mod.concatenate_chunks([empty_chunk(), empty_chunk()])
+    assert cat['data'] is None
+
+
+def test_chunk_buffer():
+    chunks = [
+            random_chunk(np.random.randint(1, 50), 30, z)
+            for z in range(20)]
+    chunks[3] = empty_chunk()
+    grown = EMaligner.ChunkBuffer()
+    for c in chunks:
+        grown.append(c)
+    grown = grown.result()
+    nnz = np.sum([c['nnz'] for c in chunks])
+    nrows = np.sum([c['nrows'] for c in chunks])
+    exact = EMaligner.ChunkBuffer(nnz, nrows)
+    for c in chunks:
+        exact.append(c)
+    assert exact.data.size == nnz
+    exact = exact.result()
+    for k in ['data', 'indices', 'indptr', 'weights', 'zlist']:
+        assert np.all(grown[k] == exact[k])
+        assert grown[k].dtype == exact[k].dtype
+    assert exact['indptr'][-1] == nnz
+    assert exact['indptr'].size == nrows + 1
+
+
+def slow_square(x):
+    time.sleep(np.random.rand() * 0.01)
+    return x * x
+
+
+def test_imap_bounded():
+    pool = ThreadPool(4)
+    fargs = list(range(50))
+    results = EMaligner.imap_bounded(pool, slow_square, fargs, 3)
+    pool.close()
+    streamed = []
+    for r in results:
+        streamed.append(r)
+        # consumer slower than the workers
+        time.sleep(0.002)
+    pool.join()
+    assert streamed == [x * x for x in fargs]
+
+
+def square_or_fail(x):
+    if x == 5:
+        raise ValueError('task failed')
+    return slow_square(x)
+
+
+def test_imap_bounded_failure():
+    pool = ThreadPool(4)
+    results = EMaligner.imap_bounded(pool, square_or_fail, range(20), 2)
+    pool.close()
+    with pytest.raises(ValueError):
+        for r in results:
+            pass
+    # the task handler stops, instead of waiting for a slot
+    joined = threading.Thread(target=pool.join)
+    joined.start()
+    joined.join(10)
+    assert not joined.is_alive()
+
+
+def test_serial_pool():
+    started = []
+    pool = EMaligner.SerialPool(started.append, (1,))
+    assert started == [1]
+    fargs = list(range(20))
+    assert pool.map(slow_square, fargs) == [x * x for x in fargs]
+    results = EMaligner.imap_bounded(pool, slow_square, fargs, 2)
+    pool.close()
+    assert list(results) == [x * x for x in fargs]
+
+
+def stub_assemble_from_db(self, zvals):
+    # a small system for each section, slower for lower z
+    z = int(zvals[0])
+    time.sleep(0.1 * (4 - z))
+    open(os.path.join(self.args['hdf5_options']['output_dir'], '%d_%d' % (
+        z, os.getpid())), 'w').close()
+    A = sparse.random(
+            100, 30, density=0.1, format='csr', random_state=z)
+    tforms = np.tile([[1.0, 0.0], [0.0, 1.0], [0.0, 0.0]], (10, 1))
+    return dict(
+            self.assemble_struct,
+            A=A,
+            weights=sparse.eye(100, format='csr'),
+            reg=sparse.eye(30, format='csr'),
+            tforms=tforms * z,
+            tids=np.array(['t%d' % i for i in range(10)]),
+            tspecs=np.array([]),
+            shared_tforms=[],
+            unused_tids=np.array([]))
+
+
+def test_parallel_sections(tmpdir, monkeypatch):
+    monkeypatch.setattr(EMaligner, 'make_dbconnection', lambda c: None)
+    monkeypatch.setattr(
+            EMaligner.renderapi.stack, 'get_z_values_for_stack',
+            lambda name, render=None: [1, 2, 3])
+    monkeypatch.setattr(
+            EMaligner.EMaligner, 'assemble_from_db', stub_assemble_from_db)
+    p = copy.deepcopy(montage_parameters)
+    p.update(
+            first_section=1,
+            last_section=3,
+            output_mode='none',
+            n_parallel_sections=2)
+    p['hdf5_options'] = {'output_dir': str(tmpdir)}
+    with pytest.raises(ValidationError):
+        EMaligner.EMaligner(
+                input_data=dict(p, output_mode='hdf5'), args=[])
+    mod = EMaligner.EMaligner(input_data=p, args=[])
+    mod.run()
+
+    # in z order, though z=1 finishes last
+    assert list(mod.section_results.keys()) == [1, 2, 3]
+    assert mod.results is mod.section_results[3]
+    for z, results in mod.section_results.items():
+        assert results['precision'] < 1e-6
+    # solved in the pool processes
+    pids = set(int(f.split('_')[1]) for f in os.listdir(str(tmpdir)))
+    assert 0 < len(pids) <= 2
+    assert os.getpid() not in pids
+
+
+def test_normal_equations():
+    chunks = [random_chunk(np.random.randint(1, 30), 40, z) for z in range(6)]
+    chunks[4] = empty_chunk()
+    used = [c for c in chunks if c['data'] is not None]
+    A = sparse.vstack([
+        sparse.csr_matrix((c['data'], c['indices'], c['indptr']), shape=(
+            c['nrows'], 40)) for c in used]).tocsr()
+    W = sparse.diags(np.concatenate([c['weights'] for c in used]))
+    expected = A.transpose().dot(W).dot(A)
+
+    Ksum = EMaligner.SparseSum(100)
+    for i, c in enumerate(chunks):
+        K = EMaligner.partial_normal_equations(c)
+        if c['data'] is None:
+            assert K is None
+            continue
+        Ksum.add(*K)
+        if i == 2:
+            # summed so far, and more added after
+            Ksum.compress()
+    K = Ksum.result(40)
+    assert K.shape == (40, 40)
+    assert np.allclose(K.toarray(), expected.toarray())
+
+
+def test_regularization_sweep(tmpdir, monkeypatch):
+    p = copy.deepcopy(montage_parameters)
+    p['regularization_sweep'] = [
+            dict(p['regularization'], default_lambda=10.0),
+            dict(p['regularization'])]
+    p['output_mode'] = 'none'
+    mod = EMaligner.EMaligner(input_data=p, args=[])
+    assert mod.args['solver']['factorization_cache_size'] == 0
+    ntiles = 20
+    A = sparse.random(200, 3 * ntiles, density=0.1, format='csr')
+    tforms = np.tile([[1.0, 0.0], [0.0, 1.0], [0.0, 0.0]], (ntiles, 1))
+    tforms += 0.01 * np.random.randn(*tforms.shape)
+
+    def assemble_from_db(self, zvals):
+        return dict(
+                self.assemble_struct,
+                A=A,
+                weights=sparse.eye(200, format='csr'),
+                reg=self.transform.create_regularization(
+                    tforms.shape[0], self.args['regularization']),
+                tforms=tforms.copy(),
+                tids=np.array(['t%d' % i for i in range(ntiles)]),
+                tspecs=np.array([]),
+                shared_tforms=[],
+                unused_tids=np.array([]))
+
+    monkeypatch.setattr(
+            EMaligner.EMaligner, 'assemble_from_db', assemble_from_db)
+    solvers.factorization_cache.clear()
+    results = mod.assemble_and_solve(np.array([1]), None)
+    sweep = results['sweep']
+    assert len(sweep) == 2
+    # last sweep setting is the main one, already factorized
+    assert results['solver']['reused'] == 'numeric'
+    assert sweep[1]['precision'] == results['precision']
+    assert sweep[1]['error'] == results['error']
+    assert sweep[0]['default_lambda'] == 10.0
+    # and not kept after the solve, with no factorization cache
+    assert len(solvers.factorization_cache.numeric) == 0
+    assert len(solvers.factorization_cache.symbolic) == 0
+
+
+def test_compact_columns():
+    keep = np.random.rand(60) > 0.3
+    keep[-1] = False
+    A = sparse.random(100, 60, density=0.1, format='csr')
+    A = A.dot(sparse.diags(keep.astype(float))).tocsr()
+    A.eliminate_zeros()
+    expected = A[:, keep].toarray()
+    K = A.transpose().dot(A).tocsr()
+    expectedK = K[keep, :][:, keep].toarray()
+
+    data = A.data
+    A = EMaligner.compact_columns(A, keep)
+    assert np.shares_memory(A.data, data)
+    assert A.shape == (100, keep.sum())
+    assert np.all(A.toarray() == expected)
+    K = EMaligner.compact_columns(K, keep, rows=True)
+    assert K.shape == (keep.sum(), keep.sum())
+    assert np.all(K.toarray() == expectedK)
+
+
+def test_hdf5_chunk_files(tmpdir):
+    A = sparse.random(300, 200, density=0.05, format='csr')
+    weights = np.random.rand(300)
+    options = {
+            'compression': 'none',
+            'compression_level': 4,
+            'chunk_size': 1000,
+            'narrow_indices': False}
+    for compression in ['none', 'gzip', 'lzf']:
+        for narrow in [False, True]:
+            fname = str(tmpdir.join('%s_%s.h5' % (compression, narrow)))
+            meta = utils.write_chunk_to_file(
+                    fname, A, weights, dict(
+                        options,
+                        compression=compression,
+                        narrow_indices=narrow))
+            assert meta['nnz'] == A.nnz
+            assert meta['nrows'] == 300
+            with h5py.File(fname, 'r') as f:
+                assert np.all(f['data'][()] == A.data)
+                assert np.all(f['weights'][()] == weights)
+                assert np.all(f['indices'][()].ravel() == A.indices)
+                assert np.all(f['indptr'][()].ravel() == A.indptr)
+                assert f['indices'].shape == (A.nnz, 1)
+                if narrow:
+                    assert f['indices'].dtype == 'int16'
+                else:
+                    assert f['indices'].dtype == 'int64'
+                if compression == 'none':
+                    assert f['data'].chunks is None
+                else:
+                    assert f['data'].compression == compression
+
+    assert utils.narrowest_int(127) == 'int8'
+    assert utils.narrowest_int(128) == 'int16'
+    assert utils.narrowest_int(2**31) == 'int64'
+
+
+def test_write_file_chunks(tmpdir):
+    scratch = tmpdir.mkdir('scratch')
+    chunks = [random_chunk(np.random.randint(1, 20), 50, z) for z in range(3)]
+    expected = sparse.vstack([
+        sparse.csr_matrix((c['data'], c['indices'], c['indptr']), shape=(
+            c['nrows'], 50))
+        for c in chunks]).tocsr()
+    shared = [
+            EMaligner.share_chunk(copy.deepcopy(c), str(scratch))
+            for c in chunks]
+    options = {
+            'output_dir': str(tmpdir),
+            'compression': 'gzip',
+            'compression_level': 4,
+            'chunk_size': 1000,
+            'narrow_indices': True}
+
+    # from writer threads, as for hdf5 output
+    writer = ThreadPool(2)
+    meta = writer.apply_async(
+            EMaligner.write_file_chunks,
+            (shared, options, 'abc', ['t1'])).get()
+    writer.close()
+    writer.join()
+    assert meta['name'] == '0_3.h5'
+    assert meta['nnz'] == expected.nnz
+    assert len(os.listdir(str(scratch))) == 0
+    with h5py.File(str(tmpdir.join('0_3.h5')), 'r') as f:
+        assert np.all(f['data'][()] == expected.data)
+        assert np.all(f['indices'][()].ravel() == expected.indices)
+        assert f.attrs['signature'] == 'abc'
+
+
+def test_read_chunk_files(tmpdir):
+    options = {
+            'compression': 'none',
+            'compression_level': 4,
+            'chunk_size': 100,
+            'narrow_indices': False}
+    matrices = []
+    metadata = []
+    for i in range(6):
+        A = sparse.random(
+                np.random.randint(1, 40), 50, density=0.2, format='csr')
+        weights = np.random.rand(A.shape[0])
+        # contiguous files are memory mapped, compressed ones are not
+        opts = dict(options, narrow_indices=(i % 2 == 1))
+        if i > 3:
+            opts['compression'] = 'gzip'
+        metadata.append(utils.write_chunk_to_file(
+                str(tmpdir.join('%d.h5' % i)), A, weights, opts))
+        matrices.append((A, weights))
+    expected = sparse.vstack([m[0] for m in matrices]).tocsr()
+
+    for nthreads in [1, 3]:
+        data, indices, indptr, weights = utils.read_chunk_files(
+                str(tmpdir),
+                [m['name'] for m in metadata],
+                np.array([m['nnz'] for m in metadata]),
+                np.array([m['nrows'] for m in metadata]),
+                nthreads=nthreads)
+        assert indices.dtype == indptr.dtype == 'int64'
+        A = sparse.csr_matrix((data, indices, indptr), shape=expected.shape)
+        assert (A != expected).nnz == 0
+        assert np.all(
+                weights == np.concatenate([m[1] for m in matrices]))
+
+
+def test_select_columns():
+    A = sparse.random(200, 60, density=0.03, format='csr')
+    weights = np.random.rand(200)
+    keep = np.zeros(60, dtype=bool)
+    keep[10:40] = True
+    # rows with any entry outside the kept columns are dropped
+    rows = np.array([np.all(keep[A[i].indices]) for i in range(200)])
+    data, indices, indptr, w = EMaligner.select_columns(
+            A.data, A.indices, A.indptr, weights, keep)
+    B = sparse.csr_matrix((data, indices, indptr), shape=(w.size, 30))
+    assert np.all(B.toarray() == A[rows][:, keep].toarray())
+    assert np.all(w == weights[rows])
+
+
+def test_chunk_signatures(tmpdir):
+    A = sparse.random(30, 40, density=0.2, format='csr')
+    weights = np.random.rand(30)
+    utils.write_chunk_to_file(str(tmpdir.join('0_1.h5')), A, weights)
+    meta = utils.write_chunk_to_file(
+            str(tmpdir.join('1_2.h5')), A, weights,
+            signature='abc', tiles_used=['t2', 't1', 't2'])
+    # only files written with a signature can be reused
+    reusable = utils.read_chunk_signatures(str(tmpdir))
+    assert list(reusable.keys()) == ['abc']
+    assert reusable['abc']['metadata'] == meta
+    assert reusable['abc']['tiles_used'] == ['t1', 't2']
+    assert utils.read_chunk_signatures(str(tmpdir.join('missing'))) == {}
+
+    tile_ids = np.array(['a', 'b', 'c', 'd'])
+    key = EMaligner.tile_columns_key(tile_ids, [1, 1, 2, 3], [1, 2])
+    # a tile added to another section
+    assert key == EMaligner.tile_columns_key(
+            np.append(tile_ids, 'e'), [1, 1, 2, 3, 3], [1, 2])
+    # or before these sections, shifting their columns
+    assert key != EMaligner.tile_columns_key(
+            np.insert(tile_ids, 0, 'e'), [0, 1, 1, 2, 3], [1, 2])
+
+
+class Tile(object):
+    def __init__(self, z):
+        self.z = z
+
+
+def test_window_overlap():
+    p = copy.deepcopy(montage_parameters)
+    p.update(solve_type='3D', output_mode='none', window_size=4)
+    p['matrix_assembly']['depth'] = [0, 1, 2]
+    # window_size or more, or less than the depth
+    for overlap in [4, 5, 1]:
+        with pytest.raises(ValidationError):
+            EMaligner.EMaligner(
+                    input_data=dict(p, window_overlap=overlap), args=[])
+    p['window_overlap_factor'] = 100.0
+    mod = EMaligner.EMaligner(input_data=p, args=[])
+    mod.transform = EMaligner.AlignerTransform(name='AffineModel')
+
+    # 2 tiles in each of z = 0 to 3, 3 columns each
+    x = np.random.randn(24, 2)
+    mod.overlap_zvals = np.array([2, 3])
+    window = {
+        'tids': np.array(['t%d' % i for i in range(8)]),
+        'tspecs': np.array([Tile(z) for z in np.repeat(range(4), 2)]),
+        'tforms': np.zeros((24, 2))}
+    mod.keep_overlap_solution(window, x)
+    assert np.all(mod.overlap_solution['tids'] == ['t4', 't5', 't6', 't7'])
+    assert np.all(mod.overlap_solution['x'] == x[12:])
+
+    # the next window, with t5 unused
+    tforms = np.zeros((15, 2))
+    result = {
+        'tids': np.array(['t7', 't4', 't6', 't8', 't9']),
+        'tforms': tforms,
+        'reg': sparse.eye(15, format='csr')}
+    mod.constrain_overlap(result)
+    assert np.all(tforms[0:3] == x[21:24])
+    assert np.all(tforms[3:6] == x[12:15])
+    assert np.all(tforms[6:9] == x[18:21])
+    assert np.all(tforms[9:] == 0)
+    assert np.all(result['reg'].diagonal() == [100.0] * 9 + [1.0] * 6)
+
+    # single column transforms, with a 1-D solution
+    mod.transform = EMaligner.AlignerTransform(
+            name='AffineModel', fullsize=True)
+    x = np.random.randn(48)
+    mod.keep_overlap_solution(dict(window, tforms=np.zeros((48, 1))), x)
+    assert mod.overlap_solution['x'].shape == (24, 1)
+    assert np.all(mod.overlap_solution['x'].ravel() == x[24:])
+    tforms = np.zeros((12, 1))
+    result = {
+        'tids': np.array(['t9', 't6']),
+        'tforms': tforms,
+        'reg': sparse.eye(12, format='csr')}
+    mod.constrain_overlap(result)
+    assert np.all(tforms[6:].ravel() == x[36:42])
+    assert np.all(tforms[:6] == 0)
+
+
+def test_chunk_signature(monkeypatch):
+    docs = [example_match('1.0', '1.0', k, 20) for k in range(3)]
+    docs += [example_match('1.0', '2.0', k, 20) for k in range(3)]
+    dbconn = FakeMongoCollection(docs)
+    monkeypatch.setattr(
+            EMaligner, 'make_dbconnection', lambda collection: [dbconn])
+    EMaligner.worker_connections.clear()
+    p = copy.deepcopy(montage_parameters)
+    p['pointmatch']['db_interface'] = 'mongo'
+    args = EMaligner.EMaligner(input_data=p, args=[]).args
+    pairs = [
+            {'z1': 1, 'z2': 1, 'section1': '1.0', 'section2': '1.0'},
+            {'z1': 1, 'z2': 2, 'section1': '1.0', 'section2': '2.0'}]
+    signature = EMaligner.chunk_signature(pairs, 'tiles', args)
+    assert signature == EMaligner.chunk_signature(pairs, 'tiles', args)
+    assert signature != EMaligner.chunk_signature(pairs, 'other', args)
+
+    # the same tile pair matched again, same number of documents
+    dbconn.documents.pop(4)
+    dbconn.insert_one(example_match('1.0', '2.0', 1, 20))
+    assert signature != EMaligner.chunk_signature(pairs, 'tiles', args)
+    EMaligner.worker_connections.clear()
+
+    # render does not tell when a pair was matched again
+    p['pointmatch']['db_interface'] = 'render'
+    p['hdf5_options'] = {'output_dir': '/tmp', 'incremental': True}
+    with pytest.raises(ValidationError):
+        EMaligner.EMaligner(
+                input_data=dict(p, output_mode='hdf5'), args=[])
+
+
+def test_assemble_tile_subset(tmpdir, monkeypatch):
+    # 2 tiles in each of z = 0, 1, 2, tile 1 unused
+    tids = np.array(['t%d' % i for i in range(6)])
+    tile_z = np.repeat([0, 1, 2], 2)
+    tforms = np.tile([[1.0, 0.0], [0.0, 1.0], [0.0, 0.0]], (6, 1))
+
+    def get_tileids_and_tforms(stack, tform_name, zvals, **kwargs):
+        ind = np.isin(tile_z, zvals)
+        return {
+                'tids': tids[ind],
+                'tforms': tforms[np.repeat(ind, 3)],
+                'tspecs': np.array([Tile(z) for z in tile_z[ind]]),
+                'shared_tforms': [],
+                'sectionIds': [],
+                'zvals': zvals}
+
+    monkeypatch.setattr(
+            EMaligner, 'get_tileids_and_tforms', get_tileids_and_tforms)
+    p = copy.deepcopy(montage_parameters)
+    p['hdf5_options'] = {'output_dir': str(tmpdir)}
+    mod = EMaligner.EMaligner(input_data=p, args=[])
+    mod.transform = EMaligner.AlignerTransform(name='AffineModel')
+
+    # rows for tile pairs 0-2, 2-3, 3-4, 4-5 and 2-5, one file per pair
+    # columns for all the tiles, used or not
+    metadata = []
+    matrices = []
+    for k, (i, j) in enumerate([(0, 2), (2, 3), (3, 4), (4, 5), (2, 5)]):
+        A = np.zeros((3, 18))
+        A[:, 3 * i:3 * i + 3] = np.random.rand(3, 3)
+        A[:, 3 * j:3 * j + 3] = -np.random.rand(3, 3)
+        A = sparse.csr_matrix(A)
+        weights = np.random.rand(3)
+        metadata.append(utils.write_chunk_to_file(
+                str(tmpdir.join('%d.h5' % k)), A, weights))
+        matrices.append((A, weights))
+    used = np.array([True, False, True, True, True, True])
+    utils.write_reg_and_tforms(
+            dict(mod.args),
+            metadata,
+            tforms[np.repeat(used, 3)],
+            sparse.eye(15, format='csr'),
+            tids[used],
+            tids[~used],
+            column_tids=tids)
+    fname = str(tmpdir.join('solution_input.h5'))
+
+    # all of it, without the unused tile's columns
+    result = mod.assemble_from_hdf5(fname, np.array([0, 1, 2]))
+    A = sparse.vstack([m[0] for m in matrices]).tocsr()
+    assert np.all(
+            result['A'].toarray() == A[:, np.repeat(used, 3)].toarray())
+
+    # z = 1 and 2, without the rows for tile 0
+    result = mod.assemble_from_hdf5(fname, np.array([1, 2]))
+    assert np.all(result['tids'] == ['t2', 't3', 't4', 't5'])
+    assert result['tforms'].shape == (12, 2)
+    assert result['reg'].shape == (12, 12)
+    assert np.all(result['A'].toarray() == A[3:, 6:].toarray())
+    assert np.all(result['weights'].data == np.concatenate(
+            [m[1] for m in matrices[1:]]))
+
+    with pytest.raises(utils.EMalignerException):
+        mod.assemble_from_hdf5(fname, np.array([5]))
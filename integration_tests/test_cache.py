@@ -0,0 +1,287 @@
+import numpy as np
+import copy
+import json
+import os
+from test_data import montage_raw_tilespecs_json
+import renderapi
+from EMaligner.cache import (
+        MatchCache,
+        TileSpecCache,
+        match_signature,
+        render_pair_counts)
+from EMaligner.utils import (
+        get_matches,
+        get_matches_for_pairs,
+        get_tileids_and_tforms)
+
+
+class FakeMongoCursor(object):
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def sort(self, keys):
+        return self
+
+    def distinct(self, key):
+        values = []
+        for d in self.documents:
+            v = d
+            for k in key.split('.'):
+                v = v[k]
+            if v not in values:
+                values.append(v)
+        return values
+
+
+class FakeMongoCollection(object):
+    def __init__(self, documents):
+        self.documents = []
+        self.nfind = 0
+        self.next_id = 0
+        for d in documents:
+            self.insert_one(d)
+
+    def insert_one(self, document):
+        # new ids, as ObjectIds are
+        document['_id'] = self.next_id
+        self.next_id += 1
+        self.documents.append(document)
+
+    def matching(self, filt):
+        if '$or' in filt:
+            return [
+                    d for d in self.documents
+                    if any(self.matches(d, f) for f in filt['$or'])]
+        return [d for d in self.documents if self.matches(d, filt)]
+
+    def matches(self, d, filt):
+        return all(d[k] == v for k, v in filt.items())
+
+    def find(self, filt, projection=None):
+        if projection != {'_id': True}:
+            # queries for more than the document ids
+            self.nfind += 1
+        return FakeMongoCursor(self.matching(filt))
+
+    def count_documents(self, filt):
+        return len(self.matching(filt))
+
+
+def example_match(pgroup, qgroup, k, npts):
+    return {
+        'pGroupId': pgroup,
+        'qGroupId': qgroup,
+        'pId': '%s_%d' % (pgroup, k),
+        'qId': '%s_%d' % (qgroup, k),
+        'matches': {
+            'p': np.random.randn(2, npts).tolist(),
+            'q': np.random.randn(2, npts).tolist(),
+            'w': np.ones(npts).tolist()}}
+
+
+collection = {
+        'db_interface': 'mongo',
+        'owner': 'test',
+        'name': ['collection']}
+
+
+def test_match_cache(tmpdir):
+    docs = [example_match('1.0', '1.0', k, 20) for k in range(5)]
+    docs += [example_match('1.0', '2.0', k, 30) for k in range(3)]
+    dbconn = FakeMongoCollection(docs)
+    cache = MatchCache(str(tmpdir), max_size_GB=1.0)
+
+    direct = get_matches('1.0', '2.0', collection, [dbconn], as_arrays=True)
+    assert dbconn.nfind == 2
+
+    # miss, then hit
+    m1 = get_matches(
+            '1.0', '2.0', collection, [dbconn], as_arrays=True, cache=cache)
+    assert dbconn.nfind == 4
+    m2 = get_matches(
+            '1.0', '2.0', collection, [dbconn], as_arrays=True, cache=cache)
+    assert dbconn.nfind == 4
+    for m in [m1, m2]:
+        for k in MatchCache.fields:
+            assert np.array_equal(getattr(m, k), getattr(direct, k))
+
+    # dicts from the cache
+    d = get_matches('1.0', '1.0', collection, [dbconn], cache=cache)
+    assert len(d) == 5
+    assert d[0]['pId'] == '1.0_0'
+
+    # new matches invalidate
+    dbconn.insert_one(example_match('1.0', '2.0', 10, 30))
+    m3 = get_matches(
+            '1.0', '2.0', collection, [dbconn], as_arrays=True, cache=cache)
+    assert len(m3) == 4
+
+    # matched again, same number of documents
+    dbconn.documents = [
+            d for d in dbconn.documents if d['pId'] != '1.0_10']
+    dbconn.insert_one(example_match('1.0', '2.0', 10, 30))
+    m3 = get_matches(
+            '1.0', '2.0', collection, [dbconn], as_arrays=True, cache=cache)
+    assert np.array_equal(m3.p, np.concatenate(
+            [m1.p, dbconn.documents[-1]['matches']['p']], axis=1))
+    nfind = dbconn.nfind
+
+    # no validation, no database
+    cache.validate = False
+    m4 = get_matches(
+            '1.0', '2.0', collection, None, as_arrays=True, cache=cache)
+    assert len(m4) == 4
+    assert dbconn.nfind == nfind
+
+
+def test_render_match_signature(monkeypatch):
+    calls = []
+
+    def get_matchcollections(owner=None, render=None):
+        calls.append(owner)
+        return [{'collectionId': {'name': 'collection'}, 'pairCount': 3}]
+
+    monkeypatch.setattr(
+            renderapi.pointmatch, 'get_matchcollections',
+            get_matchcollections)
+    render_pair_counts.clear()
+    render_collection = dict(
+            collection, db_interface='render', host='h', port=80)
+    s1 = match_signature('1.0', '2.0', render_collection, None)
+    s2 = match_signature('2.0', '3.0', render_collection, None)
+    # listed once for all the section pairs
+    assert s1 == s2
+    assert calls == ['test']
+    render_pair_counts.clear()
+
+
+def test_cache_eviction(tmpdir):
+    docs = [
+        example_match('%d.0' % z, '%d.0' % z, 0, 1000) for z in range(6)]
+    dbconn = FakeMongoCollection(docs)
+    cache = MatchCache(str(tmpdir), max_size_GB=1.0)
+    get_matches('0.0', '0.0', collection, [dbconn], cache=cache)
+    fsize = os.path.getsize(cache.path(
+        'pointmatch', ['test', ['collection'], '0.0', '0.0']))
+
+    # room for 3 files
+    cache.max_size = 3.5 * fsize
+    for z in range(1, 6):
+        get_matches('%d.0' % z, '%d.0' % z, collection, [dbconn], cache=cache)
+        # keep the first one recently used
+        get_matches('0.0', '0.0', collection, [dbconn], cache=cache)
+
+    files, total = cache.scan()
+    assert len(files) == 3
+    assert total <= cache.max_size
+    names = [os.path.basename(f[2]) for f in files]
+    for z in [0, 5]:
+        fname = cache.path(
+            'pointmatch', ['test', ['collection'], '%d.0' % z, '%d.0' % z])
+        assert os.path.basename(fname) in names
+
+
+def test_tilespec_cache(tmpdir, monkeypatch):
+    tiles = FakeMongoCollection(copy.deepcopy(montage_raw_tilespecs_json))
+    monkeypatch.setattr(
+            'EMaligner.utils.make_dbconnection',
+            lambda stack, which='tile': tiles)
+    stack = {
+            'db_interface': 'mongo',
+            'owner': 'test',
+            'project': 'project',
+            'name': ['stack']}
+    cache = TileSpecCache(str(tmpdir))
+    key = json.dumps(cache.stack_key(stack))
+    cache.timestamps[key] = '1'
+
+    direct = get_tileids_and_tforms(stack, 'AffineModel', [1015, 1016])
+    nfind = tiles.nfind
+    for i in range(2):
+        cached = get_tileids_and_tforms(
+                stack, 'AffineModel', [1015, 1016], cache=cache)
+        assert np.all(cached['tids'] == direct['tids'])
+        assert np.all(cached['tforms'] == direct['tforms'])
+        assert cached['sectionIds'] == direct['sectionIds'] == ['1015.0']
+        assert cached['zvals'] == direct['zvals'] == [1015]
+        assert [t.to_dict() for t in cached['tspecs']] == \
+            [t.to_dict() for t in direct['tspecs']]
+    # only the first pass hit the database
+    assert tiles.nfind == 2 * nfind
+
+    # stack was modified
+    cache.timestamps[key] = '2'
+    tiles.documents = tiles.documents[1:]
+    cached = get_tileids_and_tforms(
+            stack, 'AffineModel', [1015, 1016], cache=cache)
+    assert np.all(cached['tids'] == direct['tids'][1:])
+
+
+def test_concurrent_tilespec_loading(monkeypatch):
+    docs = []
+    for z in [1015, 1016, 1018, 1019, 1020]:
+        for t in copy.deepcopy(montage_raw_tilespecs_json):
+            t['z'] = float(z)
+            t['tileId'] = t['tileId'] + '_%d' % z
+            t['layout']['sectionId'] = '%d.0' % z
+            docs.append(t)
+    tiles = FakeMongoCollection(docs)
+    monkeypatch.setattr(
+            'EMaligner.utils.make_dbconnection',
+            lambda stack, which='tile': tiles)
+    stack = {
+            'db_interface': 'mongo',
+            'owner': 'test',
+            'project': 'project',
+            'name': ['stack']}
+    zvals = range(1014, 1022)
+    serial = get_tileids_and_tforms(stack, 'AffineModel', zvals)
+    threaded = get_tileids_and_tforms(
+            stack, 'AffineModel', zvals, nthreads=4)
+    assert serial['zvals'] == threaded['zvals'] == \
+        [1015, 1016, 1018, 1019, 1020]
+    assert serial['sectionIds'] == threaded['sectionIds']
+    assert np.all(serial['tids'] == threaded['tids'])
+    assert np.all(serial['tforms'] == threaded['tforms'])
+
+
+def test_bulk_match_queries(tmpdir):
+    dbconns = []
+    for c in range(2):
+        docs = []
+        for z in range(4):
+            docs += [
+                example_match('%d.0' % z, '%d.0' % z, k, 10 + c)
+                for k in range(3)]
+            docs += [
+                example_match('%d.0' % z, '%d.0' % (z + 1), k, 12)
+                for k in range(2)]
+        # one reversed pair
+        docs.append(example_match('2.0', '1.0', 7, 9))
+        dbconns.append(FakeMongoCollection(docs))
+    coll = dict(collection)
+    coll['name'] = ['c0', 'c1']
+
+    pairs = [('0.0', '0.0'), ('0.0', '1.0'), ('1.0', '2.0'), ('5.0', '5.0')]
+    bulk = get_matches_for_pairs(pairs, coll, dbconns)
+    assert [d.nfind for d in dbconns] == [1, 1]
+    assert [len(b) for b in bulk] == [6, 4, 6, 0]
+    for (iId, jId), b in zip(pairs, bulk):
+        m = get_matches(iId, jId, coll, dbconns, as_arrays=True)
+        for k in MatchCache.fields:
+            assert np.array_equal(getattr(m, k), getattr(b, k))
+
+    # through the cache, only the missing pairs are queried
+    cache = MatchCache(str(tmpdir))
+    get_matches(*pairs[1], collection=coll, dbconnection=dbconns, cache=cache)
+    nfind = [d.nfind for d in dbconns]
+    cached = get_matches_for_pairs(pairs, coll, dbconns, cache=cache)
+    assert [d.nfind for d in dbconns] == [n + 1 for n in nfind]
+    for b, c in zip(bulk, cached):
+        for k in MatchCache.fields:
+            assert np.array_equal(getattr(b, k), getattr(c, k))
+    cached = get_matches_for_pairs(pairs, coll, dbconns, cache=cache)
+    assert [d.nfind for d in dbconns] == [n + 1 for n in nfind]
@@ -0,0 +1,249 @@
+import pytest
+import numpy as np
+import scipy.sparse as sparse
+from EMaligner import solvers
+from EMaligner.utils import EMalignerException
+
+
+def spd_system(n=200):
+    A = sparse.random(3 * n, n, density=0.02, format='csr')
+    K = A.transpose().dot(A) + sparse.eye(n, format='csr')
+    x = np.random.randn(n)
+    return K.tocsc(), x, K.dot(x)
+
+
+options = {
+        'backend': 'lu',
+        'preconditioner': 'jacobi',
+        'tolerance': 1e-12,
+        'max_iterations': None,
+        'warm_start': True,
+        'drop_tolerance': 1e-4,
+        'fill_factor': 10.0,
+        'factorization_cache_size': 0,
+        'split_uv': True,
+        'ordering': 'none',
+        'split_components': False,
+        'n_threads': 1}
+
+
+@pytest.mark.parametrize(
+        'backend, preconditioner',
+        [('lu', 'none'),
+         ('cg', 'none'),
+         ('cg', 'jacobi'),
+         ('cg', 'block_jacobi'),
+         ('cg', 'ilu'),
+         ('cholmod', 'none')])
+def test_solver_backends(backend, preconditioner):
+    if backend == 'cholmod':
+        pytest.importorskip('sksparse.cholmod')
+    K, x, b = spd_system()
+    opts = dict(options, backend=backend, preconditioner=preconditioner)
+    solver = solvers.make_solver(opts, block_size=4)
+    assert solver.name == backend
+    solver.factorize(K)
+    xs = solver.solve(b)
+    assert np.allclose(xs, x, atol=1e-6)
+    assert solver.report['backend'] == backend
+    assert solver.report['factor_time'] >= 0
+    assert solver.report['solve_time'] > 0
+    assert backend in solver.message()
+
+
+def test_block_jacobi():
+    K, x, b = spd_system(40)
+    M = solvers.block_jacobi(K, 4)
+    for i in range(10):
+        block = slice(4 * i, 4 * (i + 1))
+        assert np.allclose(
+            M[block, block].toarray(),
+            np.linalg.inv(K[block, block].toarray()))
+    assert M.nnz == 40 * 4
+
+
+def test_warm_start():
+    K, x, b = spd_system()
+    opts = dict(options, backend='cg')
+    solver = solvers.make_solver(opts)
+    solver.factorize(K)
+    solver.solve(b)
+    # already at the solution
+    solver.solve(b, x0=x)
+    assert solver.report['iterations'][1] < solver.report['iterations'][0]
+    # warm start off
+    opts['warm_start'] = False
+    solver = solvers.make_solver(opts)
+    solver.factorize(K)
+    solver.solve(b, x0=x)
+    assert solver.report['iterations'][0] > 1
+    # capped
+    opts['max_iterations'] = 2
+    solver = solvers.make_solver(opts)
+    solver.factorize(K)
+    solver.solve(b)
+    assert solver.report['iterations'] == [2]
+
+
+def test_solver_choices(monkeypatch):
+    with pytest.raises(EMalignerException):
+        solvers.make_solver(dict(options, backend='not_a_solver'))
+    # falls back when scikit-sparse is missing
+    monkeypatch.setattr(solvers, 'cholesky', None)
+    solver = solvers.make_solver(dict(options, backend='cholmod'))
+    assert solver.name == 'lu'
+
+
+@pytest.mark.parametrize('backend', ['lu', 'cg', 'cholmod'])
+def test_factorization_cache(backend):
+    if backend == 'cholmod':
+        pytest.importorskip('sksparse.cholmod')
+    solvers.factorization_cache.clear()
+    K, x, b = spd_system()
+    opts = dict(options, backend=backend, factorization_cache_size=2)
+
+    solver = solvers.make_solver(opts)
+    solver.factorize(K)
+    assert solver.report['reused'] is None
+    x1 = solver.solve(b)
+
+    # same K
+    solver = solvers.make_solver(opts)
+    solver.factorize(K.copy())
+    assert solver.report['reused'] == 'numeric'
+    assert np.all(solver.solve(b) == x1)
+
+    # same pattern, new values, as for a new lambda
+    K2 = K + 10.0 * sparse.eye(K.shape[0], format='csc')
+    assert (K2 != 0).nnz == (K != 0).nnz
+    solver = solvers.make_solver(opts)
+    solver.factorize(K2)
+    expected_reuse = None if backend == 'cg' else 'symbolic'
+    assert solver.report['reused'] == expected_reuse
+    x2 = solver.solve(b)
+    assert np.allclose(K2.dot(x2), b, atol=1e-6)
+
+    # oldest entry evicted
+    K3 = K + 20.0 * sparse.eye(K.shape[0], format='csc')
+    solvers.make_solver(opts).factorize(K3)
+    assert len(solvers.factorization_cache.numeric) == 2
+    solver = solvers.make_solver(opts)
+    solver.factorize(K)
+    assert solver.report['reused'] != 'numeric'
+    solvers.factorization_cache.clear()
+
+
+@pytest.mark.parametrize('backend', ['lu', 'cg'])
+def test_multiple_rhs(backend):
+    K, x, b = spd_system()
+    B = np.transpose([b, 2 * b, -b])
+    solver = solvers.make_solver(dict(options, backend=backend))
+    solver.factorize(K)
+    X = solver.solve(B)
+    assert X.shape == B.shape
+    for i, f in enumerate([1, 2, -1]):
+        assert np.allclose(X[:, i], f * x, atol=1e-6)
+
+
+@pytest.mark.parametrize('backend', ['lu', 'cg'])
+def test_split_components(backend):
+    # 2 connected blocks and 5 columns with only a diagonal entry
+    chain = [[-1.0, 2.0, -1.0], [-1, 0, 1]]
+    K = sparse.block_diag([
+        spd_system(60)[0] + sparse.diags(*chain, shape=(60, 60)),
+        3.0 * sparse.eye(5),
+        2.0 * sparse.diags(*chain, shape=(30, 30)) + sparse.eye(30)])
+    x = np.random.randn(K.shape[0])
+    # interleaved, as tiles from different components would be
+    perm = np.random.permutation(x.size)
+    K = K.tocsr()[perm, :][:, perm].tocsc()
+    x = x[perm]
+    b = K.dot(x)
+
+    opts = dict(options, backend=backend, split_components=True, n_threads=3)
+    solver = solvers.make_solver(opts)
+    assert solver.name == 'components'
+    solver.factorize(K)
+    assert solver.report['disconnected'] == 5
+    assert solver.report['components'] == 2
+    assert solver.report['largest_component'] == 60
+    assert solver.report['backend'] == backend
+    assert np.allclose(solver.solve(b), x, atol=1e-6)
+    X = solver.solve(np.transpose([b, 2 * b]), x0=np.transpose([x, x]))
+    assert np.allclose(X[:, 1], 2 * x, atol=1e-6)
+    if backend == 'cg':
+        # 2 components, 1 + 2 right-hand sides
+        assert len(solver.report['iterations']) == 6
+    assert 'components' in solver.message()
+
+
+def test_hilbert_index():
+    x, y = np.meshgrid(np.arange(8), np.arange(8))
+    d = solvers.hilbert_index(x.ravel(), y.ravel(), order=3)
+    assert np.all(np.sort(d) == np.arange(64))
+    # each step along the curve is to a neighboring cell
+    i = np.argsort(d)
+    steps = np.abs(np.diff(x.ravel()[i])) + np.abs(np.diff(y.ravel()[i]))
+    assert np.all(steps == 1)
+
+
+@pytest.mark.parametrize('ordering', ['rcm', 'hilbert'])
+def test_orderings(ordering):
+    # a 10 x 10 grid of tiles, 3 columns each, in shuffled order
+    n = 100
+    x, y = np.meshgrid(np.arange(10), np.arange(10))
+    positions = np.transpose([x.ravel(), y.ravel(), np.zeros(n)])
+    grid = sparse.diags(
+            [-1.0, -1.0, 4.1, -1.0, -1.0], [-10, -1, 0, 1, 10], (n, n))
+    block = np.array([[2.0, 0.5, 0.1], [0.5, 2.0, 0.1], [0.1, 0.1, 1.0]])
+    K = sparse.kron(grid, block, format='csr')
+    shuffle = np.random.permutation(n)
+    cols = solvers.tile_columns(shuffle, 3)
+    K = K[cols, :][:, cols].tocsc()
+    positions = positions[shuffle]
+    x = np.random.randn(3 * n, 2)
+    b = K.dot(x)
+
+    opts = dict(options, ordering=ordering)
+    solver = solvers.make_solver(
+            opts, block_size=3, tile_positions=positions)
+    solver.factorize(K)
+    before, after = solver.report['bandwidth']
+    if ordering == 'rcm':
+        assert after < before
+    else:
+        tiles = solvers.hilbert_order(positions)
+        assert np.all(solver.perm == solvers.tile_columns(tiles, 3))
+    assert np.allclose(solver.solve(b), x)
+    assert ordering in solver.message()
+
+    # no positions to order by
+    solver = solvers.make_solver(
+            dict(options, ordering='hilbert'), block_size=3)
+    solver.factorize(K)
+    assert np.allclose(solver.solve(b), x)
+
+
+def test_uv_halves():
+    # 3 columns for u and 3 for v, per tile, as fullsize affine
+    K0, x, b = spd_system(60)
+    first = (np.arange(120) % 6) < 3
+    i0 = np.flatnonzero(first)
+    i1 = np.flatnonzero(~first)
+    P = sparse.csc_matrix(
+            (np.ones(120), (np.concatenate([i0, i1]), np.arange(120))))
+    K = P.dot(sparse.block_diag([K0, K0])).dot(P.transpose()).tocsc()
+
+    halves = solvers.uv_halves(K, 6)
+    assert np.all(halves[0] == i0)
+    assert np.all(halves[1] == i1)
+    assert (halves[2] != K0).nnz == 0
+    assert (solvers.uv_halves(K.tocsr(), 6)[2] != K0).nnz == 0
+
+    # coupled, or different, halves
+    coupled = K + sparse.csc_matrix(([1.0], ([0], [3])), shape=K.shape)
+    assert solvers.uv_halves(coupled, 6) is None
+    different = K + sparse.csc_matrix(([1.0], ([3], [3])), shape=K.shape)
+    assert solvers.uv_halves(different, 6) is None
+    extra = K + sparse.csc_matrix(([1.0], ([3], [119])), shape=K.shape)
+    assert solvers.uv_halves(extra, 6) is None
@@ -7,7 +7,8 @@ from EMaligner.transform.polynomial_model import AlignerPolynomial2DTransform
 from EMaligner.transform.utils import (
         AlignerTransformException,
         ptpair_indices,
-        arrays_for_tilepair)
+        arrays_for_tilepair,
+        MatchArrays)
 from scipy.sparse import csr_matrix
 import numpy as np
 
@@ -423,3 +424,102 @@ def test_polynomial_model():
             for j in range(i + 1):
                 assert np.all(r.data[ni::n] == pf[i])
                 ni += 1
+
+
+def test_match_arrays():
+    matches = [example_match(n) for n in [10, 0, 25, 7]]
+    for k, m in enumerate(matches):
+        m['pId'] = 'p%d' % k
+        m['qId'] = 'q%d' % k
+        m['pGroupId'] = '1.0'
+        m['qGroupId'] = '2.0'
+    marr = MatchArrays.from_dicts(iter(matches))
+    assert len(marr) == 4
+    assert np.all(marr.counts == [10, 0, 25, 7])
+    assert marr.p.shape == marr.q.shape == (2, 42)
+    assert marr.w.dtype == np.float64
+    back = marr.to_dicts()
+    for m0, m1 in zip(matches, back):
+        for key in ['pId', 'qId', 'pGroupId', 'qGroupId']:
+            assert m0[key] == m1[key]
+        for key in ['p', 'q', 'w']:
+            assert np.array_equal(m0['matches'][key], m1['matches'][key])
+
+    sub = marr.select(np.array([True, False, False, True]))
+    assert np.all(sub.pId == ['p0', 'p3'])
+    assert np.all(sub.counts == [10, 7])
+    assert np.array_equal(sub.p[:, 10:], marr.p[:, 35:])
+
+    cat = MatchArrays.concatenate([sub, MatchArrays(), marr.select([2])])
+    assert np.all(cat.qId == ['q0', 'q3', 'q2'])
+    assert np.all(cat.offsets == [0, 10, 17, 42])
+    assert np.array_equal(cat.w[17:], marr.w[10:35])
+
+    empty = MatchArrays.from_dicts([])
+    assert len(empty) == 0
+    assert empty.p.shape == (2, 0)
+
+
+def per_tilepair_CSR(t, matches, pinds, qinds, nmin, nmax, choose_random):
+    data = []
+    indices = []
+    indptr = [np.array([0])]
+    weights = []
+    for k in range(len(matches)):
+        d, ind, iptr, wts, npts = t.CSR_from_tilepair(
+                matches[k], pinds[k], qinds[k], nmin, nmax, choose_random)
+        if d is None:
+            continue
+        data.append(d)
+        indices.append(ind)
+        indptr.append(iptr + indptr[-1][-1])
+        weights.append(wts)
+    return (
+        np.concatenate(data),
+        np.concatenate(indices),
+        np.concatenate(indptr),
+        np.concatenate(weights))
+
+
+@pytest.mark.parametrize("choose_random", [True, False])
+@pytest.mark.parametrize("name, fullsize, order", [
+    ("AffineModel", False, 2),
+    ("AffineModel", True, 2),
+    ("SimilarityModel", False, 2),
+    ("Polynomial2DTransform", False, 0),
+    ("Polynomial2DTransform", False, 3)])
+def test_CSR_from_tilepairs(name, fullsize, order, choose_random):
+    t = AlignerTransform(name=name, fullsize=fullsize, order=order)
+    matches = [example_match(n) for n in [100, 3, 600, 40, 250, 0, 7]]
+    # one tile pair with zero weights
+    matches[3]['matches']['w'] = list(np.zeros(40))
+    pinds = np.array([0, 1, 2, 3, 4, 5, 6])
+    qinds = np.array([1, 2, 3, 4, 5, 6, 0])
+    nmin, nmax = 5, 500
+
+    np.random.seed(0)
+    expected = per_tilepair_CSR(
+            t, matches, pinds, qinds, nmin, nmax, choose_random)
+
+    for k, m in enumerate(matches):
+        m['pId'] = 'tile%d' % pinds[k]
+        m['qId'] = 'tile%d' % qinds[k]
+
+    np.random.seed(0)
+    marr = MatchArrays.from_dicts(matches)
+    data, indices, indptr, weights, npts = t.CSR_from_tilepairs(
+            marr, pinds, qinds, nmin, nmax, choose_random)
+    indptr = np.insert(indptr, 0, 0)
+
+    assert np.all(npts == [100, 0, 500, 0, 250, 0, 7])
+    assert np.array_equal(data, expected[0])
+    assert np.array_equal(indices, expected[1])
+    assert np.array_equal(indptr, expected[2])
+    assert np.array_equal(weights, expected[3])
+    c = csr_matrix((data, indices, indptr))
+    assert c.check_format() is None
+
+    # nothing usable
+    data, indices, indptr, weights, npts = t.CSR_from_tilepairs(
+            marr, pinds, qinds, 1000, nmax, choose_random)
+    assert data is None